@@ -0,0 +1,883 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks do chatbot, sem acesso ao Google nem à Evolution API.
+
+Uso:
+    python benchmark_camilla.py concorrencia [--mensagens 240] [--latencia-ms 20] [--latencia-envio-ms 2]
+    python benchmark_camilla.py rajadas [--utilizadores 50] [--janela-ms 1500]
+    python benchmark_camilla.py slots [--eventos 10 1000 10000]
+    python benchmark_camilla.py multiprocesso [--workers 1 2 4] [--utilizadores 200]
+    python benchmark_camilla.py carga [--utilizadores 2000] [--clientes 64] [--json resultado.json]
+    python benchmark_camilla.py limpeza [--estados 20000] [--utilizadores 16]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import chatbot_camilla as bot
+
+
+# --- DUPLOS DO GOOGLE AGENDA E DA EVOLUTION API ---
+class _PedidoFalso:
+    def __init__(self, operacao, latencia, method_id):
+        self._operacao = operacao
+        self._latencia = latencia
+        self.methodId = method_id
+
+    def execute(self, http=None):
+        time.sleep(self._latencia)
+        return self._operacao()
+
+
+def _erro_http(status):
+    return bot.HttpError(bot.httplib2.Response({'status': status}), b'{}')
+
+
+class _EventosFalsos:
+    def __init__(self, servico):
+        self._servico = servico
+
+    def list(self, calendarId=None, pageToken=None, syncToken=None, maxResults=250, **kwargs):
+        return _PedidoFalso(lambda: self._servico.listar(pageToken, syncToken, maxResults), self._servico.latencia, 'calendar.events.list')
+
+    def insert(self, calendarId, body):
+        return _PedidoFalso(lambda: self._servico.inserir(body), self._servico.latencia, 'calendar.events.insert')
+
+    def delete(self, calendarId, eventId):
+        return _PedidoFalso(lambda: self._servico.apagar(eventId), self._servico.latencia, 'calendar.events.delete')
+
+
+class _FreeBusyFalso:
+    def __init__(self, servico):
+        self._servico = servico
+
+    def query(self, body):
+        return _PedidoFalso(lambda: self._servico.ocupados(body), self._servico.latencia, 'calendar.freebusy.query')
+
+
+class _LoteFalso:
+    """BatchHttpRequest falso: um único atraso de rede para todos os pedidos do lote."""
+
+    def __init__(self, latencia, callback):
+        self._latencia = latencia
+        self._callback = callback
+        self._pedidos = []
+
+    def add(self, pedido, callback=None, request_id=None):
+        self._pedidos.append((request_id, pedido))
+
+    def execute(self, http=None):
+        time.sleep(self._latencia)
+        for request_id, pedido in self._pedidos:
+            try:
+                resposta, erro = pedido._operacao(), None
+            except bot.HttpError as e:
+                resposta, erro = None, e
+            self._callback(request_id, resposta, erro)
+
+
+class _ServicoFalso:
+    """Google Agenda em memória com a superfície usada pelo bot e latência injetada.
+
+    events().list suporta páginas e syncToken (devolve as alterações desde o token,
+    incluindo eventos cancelados); events().delete de um evento inexistente dá 404.
+    Por omissão as marcações não ocupam a agenda, para que milhares de utilizadores
+    simulados não a esgotem; com `ocupar=True` o FreeBusy devolve-as.
+    """
+
+    def __init__(self, latencia, ocupar=False):
+        self.latencia = latencia
+        self.ocupar = ocupar
+        self._eventos = {}  # id -> (seq, evento)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def events(self):
+        return _EventosFalsos(self)
+
+    def freebusy(self):
+        return _FreeBusyFalso(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _LoteFalso(self.latencia, callback)
+
+    def semear(self, remote_jid, inicio, summary="Consulta: semeada"):
+        """Cria diretamente um evento do chatbot para `remote_jid` (sem latência)."""
+        fim = inicio + bot.SLOT_DURATION
+        return self.inserir({
+            'summary': summary,
+            'start': {'dateTime': inicio.isoformat()}, 'end': {'dateTime': fim.isoformat()},
+            'extendedProperties': {'private': {'remoteJid': remote_jid}},
+        })
+
+    def inserir(self, body):
+        with self._lock:
+            if body.get('id') in self._eventos:
+                raise _erro_http(409)
+            self._seq += 1
+            evento = dict(body, id=body.get('id') or f"evento{self._seq}", status='confirmed', htmlLink='')
+            self._eventos[evento['id']] = (self._seq, evento)
+            return evento
+
+    def apagar(self, event_id):
+        with self._lock:
+            atual = self._eventos.get(event_id)
+            if atual is None or atual[1]['status'] == 'cancelled':
+                raise _erro_http(404)
+            self._seq += 1
+            self._eventos[event_id] = (self._seq, dict(atual[1], status='cancelled'))
+            return {}
+
+    def listar(self, pagina, sync_token, maximo):
+        with self._lock:
+            desde = int(sync_token) if sync_token else 0
+            itens = [evento for seq, evento in self._eventos.values() if seq > desde and (sync_token or evento['status'] != 'cancelled')]
+            token = str(self._seq)
+        inicio = int(pagina or 0)
+        resultado = {'items': itens[inicio:inicio + maximo]}
+        if inicio + maximo < len(itens):
+            resultado['nextPageToken'] = str(inicio + maximo)
+        else:
+            resultado['nextSyncToken'] = token
+        return resultado
+
+    def ocupados(self, body):
+        busy = []
+        if self.ocupar:
+            with self._lock:
+                busy = [{'start': e['start']['dateTime'], 'end': e['end']['dateTime']} for _, e in self._eventos.values() if e['status'] != 'cancelled']
+        return {'calendars': {item['id']: {'busy': busy} for item in body['items']}}
+
+
+class _CalendarFalso(bot.CalendarClientManager):
+    """CalendarClientManager com um serviço em memória no lugar do Google."""
+
+    def __init__(self, latencia, ocupar=False):
+        super().__init__()
+        self._service = _ServicoFalso(latencia, ocupar)
+
+    def _emprestar_http(self):
+        return None
+
+    def _devolver_http(self, http):
+        pass
+
+
+class _FileStateStoreContado(bot.FileStateStore):
+    """FileStateStore que conta as escritas em disco (gravações e remoções)."""
+
+    def __init__(self, directory, contagem):
+        super().__init__(directory)
+        self._contagem = contagem
+
+    def save(self, user_id, state):
+        self._contagem['escritas'] += 1
+        super().save(user_id, state)
+
+    def delete(self, user_id):
+        self._contagem['escritas'] += 1
+        super().delete(user_id)
+
+
+@contextlib.contextmanager
+def ambiente_falso(latencia, calendar=None, evolution_url=None, latencia_envio=None):
+    """Aponta o bot para um Google Agenda e um envio falsos e para um diretório de estado temporário.
+
+    Cada envio falso demora `latencia_envio` (por omissão, `latencia`). Com `evolution_url` as respostas são mesmo enviadas por HTTP para esse endereço
+    (um StubEvolution). Devolve um dicionário com o número de envios e de escritas
+    de estado feitos.
+    """
+    originais = (bot.calendar_client, bot.enviar_resposta_api, bot.state_store, bot.availability_cache,
+                 bot.user_event_index, bot.slot_holds, bot.EVOLUTION_SERVER_URL)
+    contagem = {'envios': 0, 'escritas': 0}
+    lock = threading.Lock()
+    enviar_original = bot.enviar_resposta_api
+
+    def enviar_falso(dados, texto, session=None):
+        if evolution_url:
+            enviado = enviar_original(dados, texto, session)
+        else:
+            time.sleep(latencia if latencia_envio is None else latencia_envio)
+            enviado = True
+        with lock:
+            contagem['envios'] += 1
+        return enviado
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        bot.calendar_client = calendar or _CalendarFalso(latencia)
+        bot.enviar_resposta_api = enviar_falso
+        bot.state_store = bot.CachedStateStore(_FileStateStoreContado(state_dir, contagem))
+        bot.availability_cache = bot.AvailabilityCache()
+        bot.user_event_index = bot.UserEventIndex()
+        bot.slot_holds = bot.SlotHolds()
+        if evolution_url:
+            bot.EVOLUTION_SERVER_URL = evolution_url
+            bot._destino_envio.cache_clear()
+        try:
+            yield contagem
+        finally:
+            bot.outbound_dispatcher.esvaziar()
+            (bot.calendar_client, bot.enviar_resposta_api, bot.state_store, bot.availability_cache,
+             bot.user_event_index, bot.slot_holds, bot.EVOLUTION_SERVER_URL) = originais
+            bot._destino_envio.cache_clear()
+
+
+class StubEvolution:
+    """Servidor HTTP local que faz de Evolution API e regista as mensagens recebidas.
+
+    Cada resposta demora `latencia` segundos; `esperar` bloqueia até um número ter
+    recebido um dado total de mensagens.
+    """
+
+    def __init__(self, port=0, latencia=0.0):
+        recebidas = self.recebidas = {}  # número -> [texto, ...] por ordem de chegada
+        chegadas = self.chegadas = {}  # número -> [time.perf_counter() de cada chegada]
+        cond = self._cond = threading.Condition()
+        self._lock = cond
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Sem isto, o corpo da resposta fica à espera do ACK dos cabeçalhos (Nagle + ACK atrasado, ~40 ms).
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if latencia:
+                    time.sleep(latencia)
+                with cond:
+                    recebidas.setdefault(corpo['number'], []).append(corpo['text'])
+                    chegadas.setdefault(corpo['number'], []).append(time.perf_counter())
+                    cond.notify_all()
+                self.send_response(201)
+                self.send_header('Content-Length', '2')
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def total(self):
+        with self._lock:
+            return sum(len(textos) for textos in self.recebidas.values())
+
+    def esperar(self, numero, total, timeout):
+        """Espera até `numero` ter recebido `total` mensagens. Devolve False se o tempo esgotar."""
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while len(self.recebidas.get(numero, ())) < total:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return False
+                self._cond.wait(restante)
+            return True
+
+    def limpar(self):
+        with self._lock:
+            self.recebidas.clear()
+            self.chegadas.clear()
+
+    def fechar(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def criar_app_falsa():
+    """Fábrica para o gunicorn: o app com o Google Agenda falso (latência em BENCH_LATENCIA_MS)."""
+    latencia = float(os.environ.get('BENCH_LATENCIA_MS', '20')) / 1000
+    bot.calendar_client = _CalendarFalso(latencia)
+    # Sem cache de horários, para que cada marcação pague a ida ao Google Agenda.
+    bot.availability_cache.ttl = 0
+    return bot.app
+
+
+def _payload(remote_jid, texto, message_id=None):
+    key = {'remoteJid': remote_jid, 'fromMe': False}
+    if message_id:
+        key['id'] = message_id
+    return {
+        'event': 'messages.upsert', 'instance': 'bench', 'apikey': 'bench',
+        'data': {'key': key, 'message': {'conversation': texto}},
+    }
+
+
+# --- CENÁRIOS ---
+def bench_concorrencia(total_mensagens, latencia, utilizadores_lista, latencia_envio):
+    """Mede o débito do /chat com o mesmo número de mensagens repartido por N utilizadores.
+
+    Os utilizadores repetem ROTEIRO_MARCACAO, cada repetição numa conversa nova. Sem
+    cache de horários nem reservas, cada oferta de horários vai ao Google Agenda
+    falso; cada medição inclui a entrega de todas as respostas.
+    """
+    client = bot.app.test_client()
+    resultados = []
+    ritmo_original = bot.ENVIO_RATE
+    # O limite de débito por instância mediria o limitador, não o bot.
+    bot.ENVIO_RATE = 1e9
+    bot.outbound_dispatcher._buckets.clear()
+    try:
+        with ambiente_falso(latencia, latencia_envio=latencia_envio):
+            bot.availability_cache.ttl = 0
+            bot.slot_holds.ttl = 0
+            for n_utilizadores in utilizadores_lista:
+                por_utilizador = max(total_mensagens // n_utilizadores, 1)
+
+                def conversa(indice):
+                    for i in range(por_utilizador):
+                        remote_jid = f"bench{n_utilizadores}-{indice}-{i // len(ROTEIRO_MARCACAO)}@s.whatsapp.net"
+                        client.post('/chat', json=_payload(remote_jid, ROTEIRO_MARCACAO[i % len(ROTEIRO_MARCACAO)]))
+
+                inicio = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=n_utilizadores) as pool:
+                    list(pool.map(conversa, range(n_utilizadores)))
+                bot.outbound_dispatcher.esvaziar()
+                duracao = time.perf_counter() - inicio
+                mensagens = por_utilizador * n_utilizadores
+                resultados.append((n_utilizadores, mensagens, duracao, mensagens / duracao))
+    finally:
+        bot.ENVIO_RATE = ritmo_original
+        bot.outbound_dispatcher._buckets.clear()
+    return resultados
+
+
+# Uma rajada típica do WhatsApp: três mensagens curtas seguidas.
+RAJADA = ['oi', 'tudo bem?', 'quero agendar']
+
+def bench_rajadas(n_utilizadores, intervalo, janelas, latencia):
+    """Envios e escritas de estado por rajada, sem e com agrupamento de mensagens."""
+    client = bot.app.test_client()
+    originais = (bot.COALESCE_JANELA, bot.message_coalescer.janela)
+    resultados = []
+    try:
+        for janela in janelas:
+            bot.COALESCE_JANELA = bot.message_coalescer.janela = janela
+            with ambiente_falso(latencia) as contagem:
+                def mensagem(remote_jid, texto, atraso):
+                    time.sleep(atraso)
+                    client.post('/chat', json=_payload(remote_jid, texto))
+
+                inicio = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=n_utilizadores * len(RAJADA)) as pool:
+                    for indice in range(n_utilizadores):
+                        for i, texto in enumerate(RAJADA):
+                            pool.submit(mensagem, f"rajada{indice}@s.whatsapp.net", texto, i * intervalo)
+                bot.outbound_dispatcher.esvaziar()
+                duracao = time.perf_counter() - inicio
+                bot.state_store.flush_all()
+                resultados.append((janela, n_utilizadores * len(RAJADA), contagem['envios'], contagem['escritas'], duracao))
+    finally:
+        bot.COALESCE_JANELA, bot.message_coalescer.janela = originais
+    return resultados
+
+
+def _slots_varredura_original(busy_slots, now_utc):
+    """O cálculo de get_available_slots antes do motor de intervalos (slots x eventos)."""
+    available_slots = []
+    working_hours = [datetime.time(9, 0), datetime.time(10, 30), datetime.time(15, 0), datetime.time(16, 30)]
+    for day_offset in range(1, 15):
+        day = (now_utc + datetime.timedelta(days=day_offset)).date()
+        for slot_time in working_hours:
+            slot_datetime_utc = datetime.datetime.combine(day, slot_time).replace(tzinfo=datetime.timezone.utc)
+            if slot_datetime_utc < now_utc: continue
+            is_busy = False
+            for event in busy_slots:
+                start_utc = datetime.datetime.fromisoformat(event['start'].get('dateTime'))
+                end_utc = datetime.datetime.fromisoformat(event['end'].get('dateTime'))
+                if start_utc <= slot_datetime_utc < end_utc:
+                    is_busy = True
+                    break
+            if not is_busy: available_slots.append(slot_datetime_utc)
+            if len(available_slots) >= 5: return available_slots
+    return available_slots
+
+
+def _eventos_aleatorios(n, now_utc, semente=1473):
+    """n eventos de 30 a 120 minutos espalhados pelos próximos 14 dias."""
+    rng = random.Random(semente)
+    eventos = []
+    for _ in range(n):
+        start = now_utc + datetime.timedelta(minutes=rng.randrange(0, 14 * 24 * 60))
+        end = start + datetime.timedelta(minutes=rng.randrange(30, 121))
+        eventos.append({'start': {'dateTime': start.isoformat()}, 'end': {'dateTime': end.isoformat()}})
+    eventos.sort(key=lambda e: e['start']['dateTime'])
+    return eventos
+
+
+def _cronometrar(funcao, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    return (time.perf_counter() - inicio) / repeticoes
+
+
+def bench_slots(tamanhos, repeticoes):
+    """Compara a varredura original com BusyIntervals + bisect sobre os mesmos eventos."""
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    resultados = []
+    for n in tamanhos:
+        eventos = _eventos_aleatorios(n, now_utc)
+        # A FreeBusy devolve intervalos já em formato RFC 3339; a conversão faz parte do custo medido.
+        busy = [{'start': e['start']['dateTime'], 'end': e['end']['dateTime']} for e in eventos]
+
+        def motor():
+            intervalos = bot.BusyIntervals((bot._parse_rfc3339(b['start']), bot._parse_rfc3339(b['end'])) for b in busy)
+            return bot.compute_free_slots(intervalos, now_utc)
+
+        original = _cronometrar(lambda: _slots_varredura_original(eventos, now_utc), repeticoes)
+        novo = _cronometrar(motor, repeticoes)
+        resultados.append((n, original, novo))
+    return resultados
+
+
+# Pedido de marcação até à escolha do horário: uma ida ao Google Agenda por utilizador.
+ROTEIRO_MARCACAO = ['oi', '1', 'Família', 'Niterói', '2']
+RESPOSTAS_MARCACAO = ['⚖️ Seja bem-vindo', 'Entendido. Antes', 'Obrigado. E em', 'Você já possui', 'Perfeito. Encontrei']
+ESTAGIO_FINAL_MARCACAO = 'awaiting_slot_choice'
+
+
+def _porta_livre():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _esperar_porta(url, timeout=30):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            requests.get(url, timeout=5)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} não respondeu em {timeout}s")
+
+
+def _verificar_transicoes(stub, db_path, jids):
+    """Conta utilizadores com respostas em falta, respostas a mais/fora de ordem e estados finais errados."""
+    perdidas = duplicadas = estados_errados = 0
+    for remote_jid in jids:
+        textos = stub.recebidas.get(remote_jid.split('@')[0], [])
+        if len(textos) < len(RESPOSTAS_MARCACAO):
+            perdidas += 1
+        elif len(textos) > len(RESPOSTAS_MARCACAO) or any(not t.startswith(p) for t, p in zip(textos, RESPOSTAS_MARCACAO)):
+            duplicadas += 1
+    with sqlite3.connect(db_path) as conn:
+        estagios = {user_id: json.loads(state).get('stage') for user_id, state in conn.execute("SELECT user_id, state FROM user_states")}
+    estados_errados = sum(1 for remote_jid in jids if estagios.get(remote_jid) != ESTAGIO_FINAL_MARCACAO)
+    return perdidas, duplicadas, estados_errados
+
+
+def bench_multiprocesso(workers_lista, n_utilizadores, latencia_ms, clientes):
+    """Corre o app em gunicorn com N workers no modo multi-processo e verifica as transições de estado."""
+    stub = StubEvolution()
+    resultados = []
+    try:
+        for n_workers in workers_lista:
+            stub.limpar()
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = os.path.join(tmp, 'estados.db')
+                porta = _porta_livre()
+                env = dict(
+                    os.environ,
+                    CHATBOT_MULTIPROCESSO='1', CHATBOT_STATE_BACKEND='sqlite', CHATBOT_STATE_DB=db_path,
+                    CHATBOT_LOCK_DIR=os.path.join(tmp, 'locks'), EVOLUTION_SERVER_URL=stub.url,
+                    BENCH_LATENCIA_MS=str(latencia_ms),
+                    # O limite de débito por instância mediria o limitador, não o servidor.
+                    CHATBOT_ENVIO_RATE='100000',
+                    # Cada utilizador fica com horários reservados: horários de meia em meia hora durante 60 dias.
+                    CHATBOT_SLOT_HORAS=','.join(h.strftime('%H:%M') for h in HORARIOS_CARGA), CHATBOT_SLOT_DIAS='60',
+                )
+                with open(os.path.join(tmp, 'gunicorn.log'), 'w') as log:
+                    gunicorn = subprocess.Popen(
+                        [sys.executable, '-m', 'gunicorn', '-w', str(n_workers), '-b', f'127.0.0.1:{porta}',
+                         '--chdir', os.path.dirname(os.path.abspath(__file__)), 'benchmark_camilla:criar_app_falsa()'],
+                        env=env, stdout=log, stderr=log,
+                    )
+                    try:
+                        url = f'http://127.0.0.1:{porta}'
+                        _esperar_porta(url)
+                        jids = [f"5521{n_workers:02d}{i:07d}@s.whatsapp.net" for i in range(n_utilizadores)]
+
+                        def conversa(remote_jid):
+                            with requests.Session() as sessao:
+                                for passo, texto in enumerate(ROTEIRO_MARCACAO):
+                                    sessao.post(f'{url}/chat', json=_payload(remote_jid, texto, f"{remote_jid}-{passo}"), timeout=60)
+
+                        inicio = time.perf_counter()
+                        with ThreadPoolExecutor(max_workers=clientes) as pool:
+                            list(pool.map(conversa, jids))
+                        duracao = time.perf_counter() - inicio
+
+                        esperadas = n_utilizadores * len(RESPOSTAS_MARCACAO)
+                        limite = time.monotonic() + 30
+                        while stub.total() < esperadas and time.monotonic() < limite:
+                            time.sleep(0.1)
+                    finally:
+                        gunicorn.terminate()
+                        gunicorn.wait(timeout=60)
+                mensagens = n_utilizadores * len(ROTEIRO_MARCACAO)
+                resultados.append((n_workers, mensagens, duracao, mensagens / duracao) + _verificar_transicoes(stub, db_path, jids))
+    finally:
+        stub.fechar()
+    return resultados
+
+# --- CARGA: CONVERSAS COMPLETAS ---
+# Cada passo: (mensagem do utilizador, início esperado da resposta do bot).
+ROTEIROS_CARGA = {
+    'marcacao': [
+        ('oi', '⚖️ Seja bem-vindo'), ('1', 'Entendido. Antes'), ('Família', 'Obrigado. E em'),
+        ('Niterói', 'Você já possui'), ('2', 'Perfeito. Encontrei'), ('1', 'Horário selecionado'),
+        ('Revisão de contrato', 'Ok, vamos confirmar'), ('1', 'Agendamento confirmado'),
+    ],
+    'remarcacao': [
+        ('oi', '⚖️ Seja bem-vindo'), ('2', 'Encontrei sua consulta'), ('1', 'Certo, vamos encontrar'),
+        ('Família', 'Obrigado. E em'), ('Niterói', 'Você já possui'), ('2', 'Perfeito. Encontrei'),
+        ('1', 'Horário selecionado'), ('Revisão de contrato', 'Ok, vamos confirmar'),
+        ('1', 'Agendamento confirmado com sucesso! Sua consulta anterior foi cancelada'),
+    ],
+    'cancelamento': [
+        ('oi', '⚖️ Seja bem-vindo'), ('2', 'Encontrei sua consulta'), ('2', 'Tem certeza'),
+        ('1', 'Sua consulta foi cancelada com sucesso'),
+    ],
+    # Depois da saudação o utilizador não responde: aviso e encerramento por inatividade.
+    'inatividade': [('oi', '⚖️ Seja bem-vindo')],
+}
+RESPOSTAS_INATIVIDADE = ['Olá! Notei que não', 'Sessão encerrada por inatividade']
+ROTEIROS_COM_CONSULTA = ('remarcacao', 'cancelamento')
+# Horários de meia em meia hora: cada conversa em curso reserva até SLOT_MAX_OFFERED horários,
+# e os quatro horários por dia da configuração normal esgotar-se-iam com dezenas de clientes.
+HORARIOS_CARGA = tuple(datetime.time(h, m) for h in range(24) for m in (0, 30))
+MISTURA_CARGA = 'marcacao=0.5,remarcacao=0.2,cancelamento=0.2,inatividade=0.1'
+
+
+def _mistura(texto):
+    """'marcacao=0.5,cancelamento=0.5' -> {'marcacao': 0.5, 'cancelamento': 0.5}"""
+    mistura = {}
+    for parte in texto.split(','):
+        nome, _, peso = parte.partition('=')
+        if nome.strip() not in ROTEIROS_CARGA:
+            raise argparse.ArgumentTypeError(f"roteiro desconhecido: {nome.strip()}")
+        mistura[nome.strip()] = float(peso or 1)
+    return mistura
+
+
+def _percentis(valores):
+    """p50/p95/p99, média e máximo (ms) por ordem de posição."""
+    if not valores:
+        return {'n': 0}
+    ordenados = sorted(valores)
+
+    def p(q):
+        return round(ordenados[min(int(q * len(ordenados)), len(ordenados) - 1)] * 1000, 2)
+
+    return {'n': len(ordenados), 'p50': p(0.50), 'p95': p(0.95), 'p99': p(0.99),
+            'media': round(sum(ordenados) / len(ordenados) * 1000, 2), 'max': round(ordenados[-1] * 1000, 2)}
+
+
+def _commit_git():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def bench_carga(n_utilizadores, mistura, clientes, latencia_calendar, latencia_envio, atraso_aviso, atraso_fecho,
+                fast_ack=False, timeout=30.0, porta_evolution=0, semente=2024):
+    """Conversas completas de milhares de remoteJids contra o app, o Google Agenda falso e o StubEvolution.
+
+    Cada cliente simulado envia um passo, espera pela resposta no stub e só então
+    envia o seguinte. Mede a latência do webhook (pedido ao /chat) e a latência até
+    à resposta chegar à Evolution API, e confirma cada resposta recebida.
+    """
+    rng = random.Random(semente)
+    nomes = list(mistura)
+    conversas = [(f"5521{i:09d}@s.whatsapp.net", rng.choices(nomes, [mistura[n] for n in nomes])[0]) for i in range(n_utilizadores)]
+    calendar = _CalendarFalso(latencia_calendar)
+    consulta = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=2)).replace(hour=14, minute=0, second=0, microsecond=0)
+    for remote_jid, roteiro in conversas:
+        if roteiro in ROTEIROS_COM_CONSULTA:
+            calendar.get_service().semear(remote_jid, consulta)
+
+    stub = StubEvolution(porta_evolution, latencia_envio)
+    client = bot.app.test_client()
+    originais = (bot.INACTIVITY_PROMPT_DELAY, bot.INACTIVITY_CLOSE_DELAY, bot.PIPELINE_ATIVO, bot.ENVIO_RATE, bot.SLOT_WORKING_HOURS)
+
+    def conversa(indice):
+        remote_jid, roteiro = conversas[indice]
+        numero = remote_jid.split('@')[0]
+        webhook, resposta = [], []
+        for passo, (texto, _) in enumerate(ROTEIROS_CARGA[roteiro]):
+            inicio = time.perf_counter()
+            client.post('/chat', json=_payload(remote_jid, texto, f"{remote_jid}-{passo}"))
+            webhook.append(time.perf_counter() - inicio)
+            if not stub.esperar(numero, passo + 1, timeout):
+                break
+            resposta.append(stub.chegadas[numero][passo] - inicio)
+        return webhook, resposta
+
+    try:
+        bot.INACTIVITY_PROMPT_DELAY, bot.INACTIVITY_CLOSE_DELAY = atraso_aviso, atraso_fecho
+        bot.PIPELINE_ATIVO = fast_ack
+        bot.SLOT_WORKING_HOURS = HORARIOS_CARGA
+        # O limite de débito por instância mediria o limitador, não o bot.
+        bot.ENVIO_RATE = 1e9
+        bot.outbound_dispatcher._buckets.clear()
+        with ambiente_falso(latencia_calendar, calendar=calendar, evolution_url=stub.url) as contagem:
+            # As marcações não ocupam a agenda falsa, por isso também não ficam reservadas depois de confirmadas.
+            bot.slot_holds.ttl_confirmada = 0
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clientes) as pool:
+                medicoes = list(pool.map(conversa, range(n_utilizadores)))
+            duracao = time.perf_counter() - inicio
+            # Os encerramentos por inatividade chegam depois de todas as conversas ativas.
+            limite = time.monotonic() + atraso_aviso + atraso_fecho + timeout
+            for remote_jid, roteiro in conversas:
+                if roteiro == 'inatividade':
+                    stub.esperar(remote_jid.split('@')[0], 1 + len(RESPOSTAS_INATIVIDADE), max(limite - time.monotonic(), 0))
+            bot.message_pipeline.esvaziar()
+    finally:
+        bot.INACTIVITY_PROMPT_DELAY, bot.INACTIVITY_CLOSE_DELAY, bot.PIPELINE_ATIVO, bot.ENVIO_RATE, bot.SLOT_WORKING_HOURS = originais
+        bot.outbound_dispatcher._buckets.clear()
+        stub.fechar()
+
+    por_roteiro = {nome: {'conversas': 0, 'falhas': 0, 'webhook': [], 'resposta': []} for nome in ROTEIROS_CARGA}
+    atrasos_temporizador = []
+    for (remote_jid, roteiro), (webhook, resposta) in zip(conversas, medicoes):
+        numero = remote_jid.split('@')[0]
+        esperadas = [prefixo for _, prefixo in ROTEIROS_CARGA[roteiro]]
+        if roteiro == 'inatividade':
+            esperadas += RESPOSTAS_INATIVIDADE
+            chegadas = stub.chegadas.get(numero, [])
+            if len(chegadas) >= 2:
+                atrasos_temporizador.append(chegadas[1] - chegadas[0] - atraso_aviso)
+        recebidas = stub.recebidas.get(numero, [])
+        r = por_roteiro[roteiro]
+        r['conversas'] += 1
+        r['webhook'] += webhook
+        r['resposta'] += resposta
+        if len(recebidas) != len(esperadas) or any(not t.startswith(p) for t, p in zip(recebidas, esperadas)):
+            r['falhas'] += 1
+
+    mensagens = sum(len(webhook) for webhook, _ in medicoes)
+    return {
+        'cenario': 'carga',
+        'data': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'versao': bot.CHATBOT_VERSION,
+        'commit': _commit_git(),
+        'parametros': {
+            'utilizadores': n_utilizadores, 'mistura': mistura, 'clientes': clientes,
+            'latencia_calendar_ms': latencia_calendar * 1000, 'latencia_envio_ms': latencia_envio * 1000,
+            'atraso_aviso_s': atraso_aviso, 'atraso_fecho_s': atraso_fecho, 'fast_ack': fast_ack,
+            'backend_estado': 'file+cache', 'envio_workers': bot.ENVIO_WORKERS,
+        },
+        'segundos': round(duracao, 3),
+        'mensagens': mensagens,
+        'mensagens_por_segundo': round(mensagens / duracao, 2),
+        'conversas_por_segundo': round(n_utilizadores / duracao, 2),
+        'envios': contagem['envios'],
+        'escritas_estado': contagem['escritas'],
+        'falhas': sum(r['falhas'] for r in por_roteiro.values()),
+        'webhook_ms': _percentis([v for r in por_roteiro.values() for v in r['webhook']]),
+        'resposta_ms': _percentis([v for r in por_roteiro.values() for v in r['resposta']]),
+        'atraso_temporizador_ms': _percentis(atrasos_temporizador),
+        'roteiros': {
+            nome: {'conversas': r['conversas'], 'falhas': r['falhas'],
+                   'webhook_ms': _percentis(r['webhook']), 'resposta_ms': _percentis(r['resposta'])}
+            for nome, r in por_roteiro.items() if r['conversas']
+        },
+    }
+
+
+# Um evento completo do Google Agenda, como os estados antigos guardavam em event_to_manage.
+EVENTO_LEGADO = {
+    'kind': 'calendar#event', 'etag': '"3412345678901234"', 'id': 'a1b2c3d4e5f6g7h8i9j0k1l2m3', 'status': 'confirmed',
+    'htmlLink': 'https://www.google.com/calendar/event?eid=YTFiMmMzZDRlNWY2ZzdoOGk5ajBrMWwybTMgY2FtaWxsYUBleGFtcGxlLmNvbQ',
+    'created': '2025-03-01T12:00:00.000Z', 'updated': '2025-03-01T12:00:00.000Z', 'summary': 'Consulta: Revisão de contrato',
+    'description': "Agendamento via Chatbot.\nCliente: 5521999999999@s.whatsapp.net\nÁrea: Família\nLocal: Niterói\nJá possui advogado: 2",
+    'creator': {'email': 'camilla@example.com', 'self': True}, 'organizer': {'email': 'camilla@example.com', 'self': True},
+    'start': {'dateTime': '2030-03-10T09:00:00-03:00', 'timeZone': 'America/Sao_Paulo'},
+    'end': {'dateTime': '2030-03-10T10:00:00-03:00', 'timeZone': 'America/Sao_Paulo'},
+    'iCalUID': 'a1b2c3d4e5f6g7h8i9j0k1l2m3@google.com', 'sequence': 0,
+    'extendedProperties': {'private': {'remoteJid': '5521999999999@s.whatsapp.net'}},
+    'reminders': {'useDefault': True}, 'eventType': 'default',
+}
+
+
+# Saudação, "Remarcar ou Cancelar" e recusa em agendar: mensagens baratas, sem oferta de horários.
+ROTEIRO_LIMPEZA = ['oi', '2', '2']
+
+def bench_limpeza(n_estados, n_utilizadores, mensagens, intervalo, latencia):
+    """Latência do /chat sem e durante uma passagem da limpeza sobre `n_estados` estados parados.
+
+    Metade dos estados está abandonada há mais do que o TTL; a outra metade é de
+    remarcações antigas, com o evento completo em event_to_manage. Cada utilizador
+    envia uma mensagem a cada `intervalo` segundos.
+    """
+    client = bot.app.test_client()
+    ritmo_original = bot.ENVIO_RATE
+    bot.ENVIO_RATE = 1e9
+    bot.outbound_dispatcher._buckets.clear()
+    resultados = []
+    for com_limpeza in (False, True):
+        with ambiente_falso(latencia):
+            ficheiros = bot.state_store.backend
+            agora = time.time()
+            for i in range(n_estados):
+                user_id = f"parado{i}@s.whatsapp.net"
+                if i % 2:
+                    ficheiros.save(user_id, {'stage': 'manage_event_choice', 'event_to_manage': EVENTO_LEGADO})
+                    idade = 2 * bot.STATE_COMPACTAR_APOS
+                else:
+                    ficheiros.save(user_id, {'stage': 'awaiting_main_choice', 'last_stage': 'start', 'last_bot_message': 'Olá'})
+                    idade = 2 * bot.STATE_TTL
+                os.utime(ficheiros._path(user_id), (agora - idade, agora - idade))
+            terminada = threading.Event()
+            relatorio = {}
+            latencias = []
+
+            def conversa(indice):
+                remote_jid = f"bench{indice}@s.whatsapp.net"
+                i = 0
+                while i < mensagens or (com_limpeza and not terminada.is_set()):
+                    inicio = time.perf_counter()
+                    client.post('/chat', json=_payload(remote_jid, ROTEIRO_LIMPEZA[i % len(ROTEIRO_LIMPEZA)]))
+                    latencias.append(time.perf_counter() - inicio)
+                    i += 1
+                    time.sleep(intervalo)
+
+            def limpar():
+                inicio = time.perf_counter()
+                relatorio.update(bot.StateSweeper().varrer(agora))
+                relatorio['segundos'] = time.perf_counter() - inicio
+                terminada.set()
+
+            with ThreadPoolExecutor(max_workers=n_utilizadores + 1) as pool:
+                if com_limpeza:
+                    pool.submit(limpar)
+                list(pool.map(conversa, range(n_utilizadores)))
+            resultados.append((com_limpeza, _percentis(latencias), relatorio))
+    bot.ENVIO_RATE = ritmo_original
+    bot.outbound_dispatcher._buckets.clear()
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='cenario', required=True)
+
+    p = sub.add_parser('concorrencia', help="débito do webhook em função do número de utilizadores distintos")
+    p.add_argument('--mensagens', type=int, default=240)
+    p.add_argument('--latencia-ms', type=float, default=20.0)
+    p.add_argument('--utilizadores', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    p.add_argument('--latencia-envio-ms', type=float, default=2.0)
+
+    p = sub.add_parser('rajadas', help="envios e escritas de estado por rajada de mensagens, sem e com agrupamento")
+    p.add_argument('--utilizadores', type=int, default=50)
+    p.add_argument('--intervalo-ms', type=float, default=300.0, help="tempo entre as mensagens de uma rajada")
+    p.add_argument('--janela-ms', type=float, default=1500.0)
+    p.add_argument('--latencia-ms', type=float, default=20.0)
+
+    p = sub.add_parser('slots', help="cálculo de horários livres: varredura original vs. intervalos com bisect")
+    p.add_argument('--eventos', type=int, nargs='+', default=[10, 1000, 10000])
+    p.add_argument('--repeticoes', type=int, default=5)
+
+    p = sub.add_parser('carga', help="conversas completas (marcação, remarcação, cancelamento, inatividade) em carga")
+    p.add_argument('--utilizadores', type=int, default=2000)
+    p.add_argument('--mistura', type=_mistura, default=_mistura(MISTURA_CARGA), help=f"peso de cada roteiro (predefinição: {MISTURA_CARGA})")
+    p.add_argument('--clientes', type=int, default=64, help="conversas em simultâneo")
+    p.add_argument('--latencia-calendar-ms', type=float, default=50.0)
+    p.add_argument('--latencia-envio-ms', type=float, default=10.0)
+    p.add_argument('--aviso-s', type=float, default=5.0, help="atraso do aviso de inatividade")
+    p.add_argument('--fecho-s', type=float, default=2.0, help="atraso do encerramento por inatividade")
+    p.add_argument('--fast-ack', action='store_true')
+    p.add_argument('--porta-evolution', type=int, default=0, help="porta do stub da Evolution API (0: livre)")
+    p.add_argument('--json', metavar='FICHEIRO', help="grava o resultado em JSON ('-' para o stdout)")
+
+    p = sub.add_parser('limpeza', help="latência do webhook durante a limpeza de estados abandonados")
+    p.add_argument('--estados', type=int, default=20000)
+    p.add_argument('--utilizadores', type=int, default=16)
+    p.add_argument('--mensagens', type=int, default=30, help="mensagens por utilizador (no mínimo)")
+    p.add_argument('--intervalo-ms', type=float, default=100.0, help="tempo entre as mensagens de cada utilizador")
+    p.add_argument('--latencia-ms', type=float, default=20.0)
+
+    p = sub.add_parser('multiprocesso', help="gunicorn com N workers: débito e transições perdidas/duplicadas")
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--utilizadores', type=int, default=200)
+    p.add_argument('--latencia-ms', type=float, default=150.0)
+    p.add_argument('--clientes', type=int, default=32, help="conversas em simultâneo")
+
+    args = parser.parse_args()
+    if args.cenario == 'concorrencia':
+        resultados = bench_concorrencia(args.mensagens, args.latencia_ms / 1000, args.utilizadores, args.latencia_envio_ms / 1000)
+        base = resultados[0][3]
+        print(f"{'utilizadores':>12} {'mensagens':>10} {'segundos':>9} {'msg/s':>8} {'ganho':>6}")
+        for n_utilizadores, mensagens, duracao, debito in resultados:
+            print(f"{n_utilizadores:>12} {mensagens:>10} {duracao:>9.2f} {debito:>8.1f} {debito / base:>5.1f}x")
+    elif args.cenario == 'rajadas':
+        resultados = bench_rajadas(args.utilizadores, args.intervalo_ms / 1000, [0.0, args.janela_ms / 1000], args.latencia_ms / 1000)
+        print(f"{'janela ms':>9} {'mensagens':>10} {'envios':>7} {'escritas':>9} {'segundos':>9}")
+        for janela, mensagens, envios, escritas, duracao in resultados:
+            print(f"{janela * 1000:>9.0f} {mensagens:>10} {envios:>7} {escritas:>9} {duracao:>9.2f}")
+    elif args.cenario == 'slots':
+        print(f"{'eventos':>8} {'original ms':>12} {'bisect ms':>10} {'ganho':>7}")
+        for n, original, novo in bench_slots(args.eventos, args.repeticoes):
+            print(f"{n:>8} {original * 1000:>12.3f} {novo * 1000:>10.3f} {original / novo:>6.1f}x")
+    elif args.cenario == 'carga':
+        r = bench_carga(args.utilizadores, args.mistura, args.clientes, args.latencia_calendar_ms / 1000,
+                        args.latencia_envio_ms / 1000, args.aviso_s, args.fecho_s, args.fast_ack, porta_evolution=args.porta_evolution)
+        if args.json == '-':
+            json.dump(r, sys.stdout, indent=2, ensure_ascii=False)
+            print()
+            return
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(r, f, indent=2, ensure_ascii=False)
+        print(f"{r['mensagens']} mensagens em {r['segundos']:.2f}s: {r['mensagens_por_segundo']:.1f} msg/s, "
+              f"{r['conversas_por_segundo']:.1f} conversas/s, {r['falhas']} conversas com falhas")
+        print(f"{'roteiro':>13} {'conversas':>10} {'falhas':>7} {'webhook p50':>12} {'p95':>8} {'p99':>8} {'resposta p50':>13} {'p95':>8} {'p99':>8}")
+        linhas = list(r['roteiros'].items()) + [('total', {'conversas': args.utilizadores, 'falhas': r['falhas'],
+                                                           'webhook_ms': r['webhook_ms'], 'resposta_ms': r['resposta_ms']})]
+        for nome, d in linhas:
+            w, e = d['webhook_ms'], d['resposta_ms']
+            print(f"{nome:>13} {d['conversas']:>10} {d['falhas']:>7} {w.get('p50', 0):>12.1f} {w.get('p95', 0):>8.1f} {w.get('p99', 0):>8.1f} "
+                  f"{e.get('p50', 0):>13.1f} {e.get('p95', 0):>8.1f} {e.get('p99', 0):>8.1f}")
+        if r['atraso_temporizador_ms']['n']:
+            t = r['atraso_temporizador_ms']
+            print(f"atraso dos temporizadores de inatividade: p50 {t['p50']:.1f} ms, p99 {t['p99']:.1f} ms")
+    elif args.cenario == 'limpeza':
+        print(f"{'limpeza':>8} {'mensagens':>10} {'webhook p50':>12} {'p95':>8} {'p99':>8} {'max':>8}")
+        for com_limpeza, w, r in bench_limpeza(args.estados, args.utilizadores, args.mensagens, args.intervalo_ms / 1000, args.latencia_ms / 1000):
+            print(f"{'sim' if com_limpeza else 'não':>8} {w['n']:>10} {w['p50']:>12.1f} {w['p95']:>8.1f} {w['p99']:>8.1f} {w['max']:>8.1f}")
+            if com_limpeza:
+                print(f"{r['examinados']} estados examinados em {r['segundos']:.2f}s: {r['expirados']} expirados, "
+                      f"{r['compactados']} compactados, {r['bytes'] / 1024:.0f} KiB libertados")
+    elif args.cenario == 'multiprocesso':
+        resultados = bench_multiprocesso(args.workers, args.utilizadores, args.latencia_ms, args.clientes)
+        base = resultados[0][3]
+        print(f"{'workers':>7} {'mensagens':>10} {'segundos':>9} {'msg/s':>8} {'ganho':>6} {'perdidas':>9} {'duplicadas':>11} {'estado errado':>14}")
+        for n_workers, mensagens, duracao, debito, perdidas, duplicadas, errados in resultados:
+            print(f"{n_workers:>7} {mensagens:>10} {duracao:>9.2f} {debito:>8.1f} {debito / base:>5.1f}x {perdidas:>9} {duplicadas:>11} {errados:>14}")
+
+
+if __name__ == "__main__":
+    main()
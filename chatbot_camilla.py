@@ -2,15 +2,33 @@
 
 from flask import Flask, request, jsonify
 import logging
+import logging.handlers
 import requests
 import datetime
 import os
 import json
 import threading
 import time
-import copy
+import queue
+import weakref
+import sqlite3
+import collections
+import atexit
+import argparse
+import heapq
+import bisect
+import functools
+import random
+import zlib
+import re
+import fcntl
+import uuid
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
@@ -18,188 +36,2170 @@ from googleapiclient.errors import HttpError
 
 # --- CONFIGURAÇÃO ---
 CHATBOT_VERSION = "3.5 (Race Condition Fix)"
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Os pedidos só enfileiram os registos de log; uma thread escreve-os no stderr.
+_log_fila = queue.SimpleQueue()
+_log_saida = logging.StreamHandler()
+_log_saida.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_entrada = logging.handlers.QueueHandler(_log_fila)
+_log_entrada.setFormatter(logging.Formatter('%(message)s'))  # a formatação completa é feita pelo listener
+logging.basicConfig(level=logging.INFO, handlers=[_log_entrada])
+
+def _iniciar_log():
+    # Também no filho após um fork (gunicorn --preload): a thread do listener não passa para ele.
+    global _log_listener
+    _log_listener = logging.handlers.QueueListener(_log_fila, _log_saida)
+    _log_listener.start()
+
+_iniciar_log()
+os.register_at_fork(after_in_child=_iniciar_log)
+atexit.register(lambda: _log_listener.stop())
 app = Flask(__name__)
 
+# Modo multi-processo (gunicorn -w N): locks por utilizador entre processos, estado
+# partilhado em SQLite e um único processo eleito para os temporizadores de inatividade.
+MULTIPROCESSO = os.environ.get('CHATBOT_MULTIPROCESSO', '0') == '1'
+LOCK_DIR = os.environ.get('CHATBOT_LOCK_DIR', 'user_locks')
+LOCK_STRIPES = 1024
+
 # --- CONFIGURAÇÃO DO GOOGLE AGENDA ---
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 CALENDAR_ID = 'primary'
 
-# --- GESTÃO DE ESTADO BASEADA EM FICHEIROS ---
+# Horários de consulta oferecidos (interpretados no fuso SLOT_TIMEZONE)
+SLOT_WORKING_HOURS = tuple(datetime.time.fromisoformat(h.strip()) for h in os.environ.get('CHATBOT_SLOT_HORAS', '09:00,10:30,15:00,16:30').split(','))
+SLOT_DURATION = datetime.timedelta(minutes=int(os.environ.get('CHATBOT_SLOT_DURACAO_MIN', '60')))
+SLOT_HORIZON_DAYS = int(os.environ.get('CHATBOT_SLOT_DIAS', '14'))
+SLOT_TIMEZONE = datetime.timezone(datetime.timedelta(hours=float(os.environ.get('CHATBOT_SLOT_UTC_OFFSET', '0'))))
+SLOT_MAX_OFFERED = 5
+# Reservas dos horários oferecidos: ninguém mais os recebe até a reserva expirar ou ser libertada.
+SLOT_HOLD_TTL = int(os.environ.get('CHATBOT_SLOT_RESERVA_TTL', '600'))  # segundos
+SLOT_HOLD_CONFIRMADA_TTL = 60  # depois da marcação, até a cache de horários refletir o evento
+SLOT_HOLD_PERSISTENTE = os.environ.get('CHATBOT_SLOT_RESERVA_PERSISTENTE', '0') == '1'  # reservas em STATE_DB
+
+# --- GESTÃO DE ESTADO ---
+STATE_BACKEND = os.environ.get('CHATBOT_STATE_BACKEND', 'file')  # 'file' ou 'sqlite'
 STATE_DIR = "user_states_data"
-if not os.path.exists(STATE_DIR):
-    os.makedirs(STATE_DIR)
+STATE_DB = os.environ.get('CHATBOT_STATE_DB', 'user_states.db')
+STATE_CACHE_SIZE = int(os.environ.get('CHATBOT_STATE_CACHE_SIZE', '1024'))  # 0 desativa a cache
+DEDUP_TTL = 600  # segundos durante os quais um data.key.id repetido é ignorado
+DEDUP_MAX_IDS = int(os.environ.get('CHATBOT_DEDUP_MAX', '50000'))
+DEDUP_PERSISTENTE = os.environ.get('CHATBOT_DEDUP_PERSISTENTE', '0') == '1'  # requer o backend sqlite
+# Limpeza de estados abandonados (conversas cujo temporizador se perdeu num reinício).
+STATE_TTL = int(os.environ.get('CHATBOT_STATE_TTL', '86400'))  # segundos sem escritas até o estado expirar
+STATE_SWEEP_INTERVAL = int(os.environ.get('CHATBOT_STATE_LIMPEZA_INTERVALO', '300'))  # 0 desativa
+STATE_SWEEP_LOTE = 200  # entradas examinadas entre pausas
+STATE_SWEEP_PAUSA = 0.05  # segundos
+STATE_COMPACTAR_APOS = 3600  # segundos sem escritas até os campos volumosos serem aparados
 
-# Lock para garantir que o acesso ao estado de todos os utilizadores seja atómico
-user_states_lock = threading.Lock()
+# --- MÉTRICAS ---
+METRICAS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-def get_user_state(user_id):
-    """Carrega o estado do utilizador a partir de um ficheiro JSON."""
-    filepath = os.path.join(STATE_DIR, f"{user_id}.json")
-    if os.path.exists(filepath):
+def _etiqueta(nome, valor):
+    return f'{{{nome}="{valor}"}}' if nome else ''
+
+class Contador:
+    """Contador monótono, com uma série por valor da etiqueta (opcional)."""
+
+    def __init__(self, nome, ajuda, etiqueta=None):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.etiqueta = etiqueta
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, valor=None, n=1):
+        with self._lock:
+            self._series[valor] = self._series.get(valor, 0) + n
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} counter"]
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: str(item[0]))
+        linhas += [f"{self.nome}{_etiqueta(self.etiqueta, valor)} {total}" for valor, total in series]
+        return linhas
+
+class Medidor:
+    """Valor lido no momento da recolha: `funcao()` devolve um número ou {valor_da_etiqueta: número}."""
+
+    def __init__(self, nome, ajuda, funcao, etiqueta=None, tipo='gauge'):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.funcao = funcao
+        self.etiqueta = etiqueta
+        self.tipo = tipo
+
+    def exportar(self):
+        valores = self.funcao()
+        if not isinstance(valores, dict):
+            valores = {None: valores}
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        linhas += [f"{self.nome}{_etiqueta(self.etiqueta, valor)} {numero}" for valor, numero in sorted(valores.items(), key=lambda item: str(item[0]))]
+        return linhas
+
+class _Cronometro:
+    __slots__ = ('_histograma', '_valor', '_inicio')
+
+    def __init__(self, histograma, valor):
+        self._histograma = histograma
+        self._valor = valor
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histograma.observar(time.perf_counter() - self._inicio, self._valor)
+
+class Histograma:
+    """Histograma de durações (segundos), com uma série por valor da etiqueta (opcional).
+
+    Cada observação é um bisect e um incremento sob um lock, para que medir o
+    caminho de cada mensagem custe só alguns microssegundos; os buckets só são
+    acumulados na exportação.
+    """
+
+    def __init__(self, nome, ajuda, etiqueta=None, buckets=METRICAS_BUCKETS):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.etiqueta = etiqueta
+        self.buckets = buckets
+        self._series = {}  # valor -> [contagem por bucket..., +Inf, soma]
+        self._lock = threading.Lock()
+
+    def observar(self, segundos, valor=None):
+        i = bisect.bisect_left(self.buckets, segundos)
+        with self._lock:
+            serie = self._series.get(valor)
+            if serie is None:
+                serie = self._series[valor] = [0] * (len(self.buckets) + 1) + [0.0]
+            serie[i] += 1
+            serie[-1] += segundos
+
+    def cronometrar(self, valor=None):
+        return _Cronometro(self, valor)
+
+    def exportar(self):
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+        with self._lock:
+            series = sorted(((valor, list(serie)) for valor, serie in self._series.items()), key=lambda item: str(item[0]))
+        for valor, serie in series:
+            prefixo = f'{self.etiqueta}="{valor}",' if self.etiqueta else ''
+            acumulado = 0
+            for limite, contagem in zip(self.buckets + ('+Inf',), serie):
+                acumulado += contagem
+                linhas.append(f'{self.nome}_bucket{{{prefixo}le="{limite}"}} {acumulado}')
+            linhas.append(f"{self.nome}_sum{_etiqueta(self.etiqueta, valor)} {serie[-1]}")
+            linhas.append(f"{self.nome}_count{_etiqueta(self.etiqueta, valor)} {acumulado}")
+        return linhas
+
+class Metricas:
+    """Registo das métricas do processo, exportadas no formato de texto do Prometheus."""
+
+    def __init__(self):
+        self._metricas = []
+
+    def _registar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def contador(self, nome, ajuda, etiqueta=None):
+        return self._registar(Contador(nome, ajuda, etiqueta))
+
+    def histograma(self, nome, ajuda, etiqueta=None, buckets=METRICAS_BUCKETS):
+        return self._registar(Histograma(nome, ajuda, etiqueta, buckets))
+
+    def medidor(self, nome, ajuda, funcao, etiqueta=None, tipo='gauge'):
+        return self._registar(Medidor(nome, ajuda, funcao, etiqueta, tipo))
+
+    def exportar(self):
+        linhas = []
+        for metrica in self._metricas:
+            try:
+                linhas += metrica.exportar()
+            except Exception as e:
+                logging.error(f"Erro ao exportar a métrica {metrica.nome}: {e}")
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+METRICA_CHAT = metricas.histograma('chatbot_chat_segundos', "Duração dos pedidos ao /chat.")
+METRICA_ETAPA = metricas.histograma('chatbot_etapa_segundos', "Duração de processa_conversa por etapa da conversa.", 'etapa')
+METRICA_CALENDAR = metricas.histograma('chatbot_calendar_segundos', "Duração dos pedidos à API do Google Agenda.", 'operacao')
+METRICA_CALENDAR_ERROS = metricas.contador('chatbot_calendar_erros_total', "Pedidos à API do Google Agenda que falharam.", 'operacao')
+METRICA_ENVIO = metricas.histograma('chatbot_envio_segundos', "Duração de cada tentativa de envio à Evolution API.")
+METRICA_ENVIO_ERROS = metricas.contador('chatbot_envio_erros_total', "Tentativas de envio à Evolution API que falharam.", 'tipo')
+METRICA_LOCK = metricas.histograma('chatbot_lock_espera_segundos', "Espera pelo lock de um utilizador.")
+METRICA_LIMPEZA = metricas.contador('chatbot_estados_limpos_total', "Estados expirados ou compactados pela limpeza.", 'acao')
+METRICA_LIMPEZA_BYTES = metricas.contador('chatbot_estados_bytes_recuperados_total', "Bytes de estado libertados pela limpeza.")
+
+# --- LOCKS POR UTILIZADOR ---
+class _UserLock:
+    """Lock de um utilizador; existe apenas enquanto alguém o referencia."""
+    __slots__ = ('_lock', '__weakref__')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._lock.acquire(blocking, timeout)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        inicio = time.perf_counter()
+        self._lock.acquire()
+        METRICA_LOCK.observar(time.perf_counter() - inicio)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+class _ProcessUserLock:
+    """Lock de um utilizador partilhado entre processos (modo multi-processo).
+
+    Junta um lock de thread a um flock num ficheiro de LOCK_DIR (um por faixa de
+    utilizadores). Ao entrar descarta a cópia do estado em cache, que outro processo
+    pode ter alterado; ao sair grava o estado antes de libertar o flock.
+    """
+    __slots__ = ('_user_id', '_path', '_lock', '_fd', '__weakref__')
+
+    def __init__(self, user_id):
+        self._user_id = user_id
+        self._path = os.path.join(LOCK_DIR, f"{zlib.crc32(user_id.encode()) % LOCK_STRIPES}.lock")
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        inicio = time.perf_counter()
+        self._lock.acquire()
+        try:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+        METRICA_LOCK.observar(time.perf_counter() - inicio)
+        self._fd = fd
+        state_store.descartar(self._user_id)
+        return True
+
+    def release(self):
+        try:
+            state_store.flush(self._user_id)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class KeyedLocks:
+    """Locks por chave (remoteJid), guardados por referência fraca.
+
+    Mensagens do mesmo utilizador continuam a ser processadas em ordem, mas
+    utilizadores diferentes já não esperam uns pelos outros. Quem usa o lock
+    deve manter a referência devolvida por `get` até o libertar.
+    """
+
+    def __init__(self, fabrica=lambda key: _UserLock()):
+        self._fabrica = fabrica
+        self._locks = weakref.WeakValueDictionary()
+        self._guard = threading.Lock()
+
+    def get(self, key):
+        with self._guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._fabrica(key)
+                self._locks[key] = lock
+            return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+# Acesso ao estado de cada utilizador (leitura, transição e escrita são atómicas por utilizador)
+if MULTIPROCESSO:
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    user_locks = KeyedLocks(_ProcessUserLock)
+else:
+    user_locks = KeyedLocks()
+
+# --- FILAS PARTICIONADAS ---
+_FIM = object()
+
+class PartitionedQueue:
+    """Filas limitadas, cada uma atendida por um worker próprio.
+
+    A mesma chave (remoteJid) vai sempre para a mesma fila, o que mantém a ordem
+    por utilizador sem serializar utilizadores diferentes. `handler(recurso, item)`
+    corre no worker; `recurso` é criado por `init_worker()` uma vez por worker.
+    """
+
+    def __init__(self, nome, handler, workers, queue_size, init_worker=None):
+        self.nome = nome
+        self._handler = handler
+        self._init_worker = init_worker
+        self._filas = [queue.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self._reservas = [0] * workers  # lugares guardados por `reservar`, por partição
+        self._reservas_lock = threading.Condition()  # notificada quando um lugar fica livre
+        self._threads = []
+        self._lock = threading.Lock()
+        self._aberta = True
+
+    def _iniciar(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for indice, fila in enumerate(self._filas):
+                thread = threading.Thread(target=self._worker, args=(fila,), name=f"{self.nome}-{indice}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _particao(self, key):
+        return zlib.crc32(key.encode()) % len(self._filas)
+
+    def reservar(self, key, timeout=0):
+        """Guarda um lugar na partição de `key` para um `submeter(..., reservado=True)` posterior.
+
+        Espera até `timeout` segundos por um lugar; devolve False se a fila continuar
+        cheia ou estiver fechada. Os lugares reservados contam para a capacidade, pelo
+        que o `submeter` reservado nunca encontra a fila cheia. Um lugar que acabe por
+        não ser usado é devolvido com `libertar`.
+        """
+        indice = self._particao(key)
+        fila = self._filas[indice]
+        limite = time.monotonic() + timeout
+        with self._reservas_lock:
+            while self._aberta and fila.qsize() + self._reservas[indice] >= fila.maxsize:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return False
+                self._reservas_lock.wait(restante)
+            if not self._aberta:
+                return False
+            self._reservas[indice] += 1
+        return True
+
+    def libertar(self, key):
+        """Devolve um lugar reservado que não chegou a ser usado."""
+        with self._reservas_lock:
+            self._reservas[self._particao(key)] -= 1
+            self._reservas_lock.notify_all()
+
+    def submeter(self, key, item, reservado=False):
+        """Enfileira `item` na partição de `key`. Devolve False se a fila estiver cheia ou fechada."""
+        indice = self._particao(key)
+        fila = self._filas[indice]
+        with self._reservas_lock:
+            if reservado:
+                self._reservas[indice] -= 1
+            if not self._aberta:
+                return False
+            if not reservado and fila.qsize() + self._reservas[indice] >= fila.maxsize:
+                return False
+            # Só os workers retiram itens: a verificação acima garante lugar.
+            fila.put_nowait(item)
+        self._iniciar()
+        return True
+
+    def pendentes(self):
+        return sum(fila.qsize() for fila in self._filas)
+
+    def esvaziar(self):
+        """Bloqueia até todos os itens enfileirados terem sido tratados."""
+        for fila in self._filas:
+            fila.join()
+
+    def fechar(self, timeout=30):
+        """Deixa de aceitar itens, trata os que já estão nas filas e termina os workers."""
+        with self._reservas_lock:
+            self._aberta = False
+            self._reservas_lock.notify_all()
+        if not self._threads:
+            return
+        for fila in self._filas:
+            fila.put(_FIM)
+        limite = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(limite - time.monotonic(), 0))
+
+    def _worker(self, fila):
+        recurso = self._init_worker() if self._init_worker else None
+        while True:
+            item = fila.get()
+            with self._reservas_lock:
+                self._reservas_lock.notify_all()
+            try:
+                if item is _FIM:
+                    return
+                self._handler(recurso, item)
+            except Exception as e:
+                logging.error(f"Erro no worker {self.nome}: {e}")
+            finally:
+                fila.task_done()
+
+class StateStore:
+    """Interface dos armazenamentos de estado das conversas.
+
+    `get` devolve o dicionário de estado ou None se o utilizador não tiver estado.
+    """
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def save(self, user_id, state):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def scan(self):
+        """Itera (user_id, updated_at, bytes) de todos os estados, sem os carregar."""
+        raise NotImplementedError
+
+    def stat(self, user_id):
+        """Devolve (updated_at, bytes) do estado guardado, ou None."""
+        raise NotImplementedError
+
+    def count(self):
+        """Número de estados guardados."""
+        return sum(1 for _ in self.scan())
+
+    def flush(self, user_id):
+        """Torna durável o estado pendente de um utilizador (no-op nos backends sem cache)."""
+
+    def flush_all(self):
+        """Torna durável todo o estado pendente."""
+
+    def descartar(self, user_id):
+        """Esquece a cópia em cache do estado de um utilizador (no-op nos backends sem cache)."""
+
+    def due_timers(self, agora):
+        """Devolve [(user_id, estado)] com um temporizador de inatividade vencido em `agora`."""
+        vencidos = []
+        for user_id in self.keys():
+            state = self.get(user_id)
+            if state and state.get('timer_id') and state.get('timer_deadline') and state['timer_deadline'] <= agora:
+                vencidos.append((user_id, state))
+        return vencidos
+
+    def save_message_id(self, message_id, seen_at):
+        """Regista um ID de mensagem processada. Devolve False se já estava registado."""
+        return True
+
+    def load_message_ids(self, since):
+        """Devolve [(message_id, seen_at)] registados depois de `since`."""
+        return []
+
+    def forget_message_id(self, message_id):
+        """Remove o registo de um ID de mensagem, para que volte a ser aceite."""
+
+class FileStateStore(StateStore):
+    """Um ficheiro JSON por utilizador em `directory`."""
+
+    def __init__(self, directory=STATE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def get(self, user_id):
+        filepath = self._path(user_id)
+        if not os.path.exists(filepath):
+            return None
         try:
             with open(filepath, 'r') as f:
                 return json.load(f)
         except (json.JSONDecodeError, IOError) as e:
             logging.error(f"Erro ao carregar estado para {user_id}: {e}")
-            return {'stage': 'start'}
-    return {'stage': 'start'}
+            return None
+
+    def save(self, user_id, state):
+        filepath = self._path(user_id)
+        try:
+            # Escreve num ficheiro temporário e substitui, para nunca deixar um JSON truncado.
+            # O nome é único por escrita: duas escritas do mesmo utilizador não partilham o temporário.
+            temporario = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporario, 'w') as f:
+                json.dump(state, f, indent=4)
+            os.replace(temporario, filepath)
+        except IOError as e:
+            logging.error(f"Erro ao guardar estado para {user_id}: {e}")
+
+    def delete(self, user_id):
+        filepath = self._path(user_id)
+        if os.path.exists(filepath):
+            try:
+                os.remove(filepath)
+            except OSError as e:
+                logging.error(f"Erro ao apagar estado para {user_id}: {e}")
+
+    def keys(self):
+        return [nome[:-len('.json')] for nome in os.listdir(self.directory) if nome.endswith('.json')]
+
+    def scan(self):
+        with os.scandir(self.directory) as entradas:
+            for entrada in entradas:
+                if entrada.name.endswith('.json'):
+                    try:
+                        info = entrada.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entrada.name[:-len('.json')], info.st_mtime, info.st_size
+
+    def stat(self, user_id):
+        try:
+            info = os.stat(self._path(user_id))
+        except FileNotFoundError:
+            return None
+        return info.st_mtime, info.st_size
+
+def _ligacao_sqlite(local, path):
+    """A ligação a `path` da thread atual (guardada em `local`, um threading.local)."""
+    # Uma ligação herdada através de fork (gunicorn --preload) não pode ser reutilizada.
+    if getattr(local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = conn
+        local.pid = os.getpid()
+    return local.conn
+
+class SQLiteStateStore(StateStore):
+    """Estado numa tabela SQLite em modo WAL, com uma ligação por thread."""
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_states ("
+                "user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL, timer_deadline REAL)"
+            )
+            colunas = {row[1] for row in conn.execute("PRAGMA table_info(user_states)")}
+            if 'timer_deadline' not in colunas:
+                conn.execute("ALTER TABLE user_states ADD COLUMN timer_deadline REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS user_states_timer_deadline ON user_states (timer_deadline)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed_messages ("
+                "message_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS processed_messages_seen_at ON processed_messages (seen_at)")
+        self._mensagens_registadas = 0
+
+    def _conn(self):
+        return _ligacao_sqlite(self._local, self.path)
+
+    def get(self, user_id):
+        try:
+            row = self._conn().execute("SELECT state FROM user_states WHERE user_id = ?", (user_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Erro ao carregar estado para {user_id}: {e}")
+            return None
+
+    def save(self, user_id, state):
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT INTO user_states (user_id, state, updated_at, timer_deadline) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, "
+                    "timer_deadline = excluded.timer_deadline",
+                    (user_id, json.dumps(state, separators=(',', ':')), time.time(),
+                     state.get('timer_deadline') if state.get('timer_id') else None),
+                )
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao guardar estado para {user_id}: {e}")
+
+    def delete(self, user_id):
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao apagar estado para {user_id}: {e}")
+
+    def keys(self):
+        return [row[0] for row in self._conn().execute("SELECT user_id FROM user_states")]
+
+    def scan(self, pagina=500):
+        # Paginação por chave: nenhuma leitura fica aberta entre páginas.
+        apos = ''
+        while True:
+            rows = self._conn().execute(
+                "SELECT user_id, updated_at, length(CAST(state AS BLOB)) FROM user_states WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (apos, pagina),
+            ).fetchall()
+            yield from rows
+            if len(rows) < pagina:
+                return
+            apos = rows[-1][0]
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM user_states").fetchone()[0]
+
+    def stat(self, user_id):
+        return self._conn().execute(
+            "SELECT updated_at, length(CAST(state AS BLOB)) FROM user_states WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+    def due_timers(self, agora):
+        rows = self._conn().execute(
+            "SELECT user_id, state FROM user_states WHERE timer_deadline IS NOT NULL AND timer_deadline <= ?", (agora,)
+        ).fetchall()
+        return [(user_id, json.loads(state)) for user_id, state in rows]
+
+    def save_message_id(self, message_id, seen_at):
+        try:
+            with self._conn() as conn:
+                novo = conn.execute("INSERT OR IGNORE INTO processed_messages (message_id, seen_at) VALUES (?, ?)", (message_id, seen_at)).rowcount == 1
+                self._mensagens_registadas += 1
+                if self._mensagens_registadas % 1000 == 0:
+                    conn.execute("DELETE FROM processed_messages WHERE seen_at < ?", (seen_at - DEDUP_TTL,))
+                return novo
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao registar a mensagem {message_id}: {e}")
+            return True
+
+    def load_message_ids(self, since):
+        return self._conn().execute(
+            "SELECT message_id, seen_at FROM processed_messages WHERE seen_at >= ? ORDER BY seen_at", (since,)
+        ).fetchall()
+
+    def forget_message_id(self, message_id):
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM processed_messages WHERE message_id = ?", (message_id,))
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao esquecer a mensagem {message_id}: {e}")
+
+class CachedStateStore(StateStore):
+    """Cache LRU em memória, com escrita diferida, sobre outro StateStore.
+
+    `save` e `delete` só alteram a cache; o backend é escrito em `flush`, quando
+    uma entrada pendente sai da cache ou no fim do processo. Assim cada mensagem
+    faz no máximo uma leitura e uma escrita durável.
+
+    Até a escrita no backend terminar, o estado fica em `_em_escrita`, onde `get`
+    o continua a encontrar. As escritas de um mesmo utilizador são serializadas e
+    uma escrita já ultrapassada por outra mais recente é descartada.
+    """
+
+    def __init__(self, backend, capacity=STATE_CACHE_SIZE):
+        self.backend = backend
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()  # user_id -> [estado ou None, pendente]
+        self._em_escrita = {}  # user_id -> (sequência, estado ou None)
+        self._seq = 0
+        self._escritas = KeyedLocks()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                return dict(entry[0]) if entry[0] is not None else None
+            if user_id in self._em_escrita:
+                state = self._em_escrita[user_id][1]
+                return dict(state) if state is not None else None
+            seq = self._seq
+        state = self.backend.get(user_id)
+        with self._lock:
+            if user_id not in self._entries:
+                if user_id in self._em_escrita:
+                    state = self._em_escrita[user_id][1]
+                elif self._seq != seq:
+                    # Houve escritas durante a leitura: esta cópia pode já estar ultrapassada.
+                    return dict(state) if state is not None else None
+                self._entries[user_id] = [state, False]
+            entry = self._entries[user_id]
+            evicted = self._evict()
+            state = dict(entry[0]) if entry[0] is not None else None
+        self._write_back(evicted)
+        return state
+
+    def save(self, user_id, state):
+        self._put(user_id, dict(state))
+
+    def delete(self, user_id):
+        self._put(user_id, None)
+
+    def _put(self, user_id, state):
+        with self._lock:
+            self._entries[user_id] = [state, True]
+            self._entries.move_to_end(user_id)
+            evicted = self._evict()
+        self._write_back(evicted)
+
+    def _pendente(self, user_id, state):
+        # Chamado com `_lock`: regista a escrita em curso e devolve o item para `_write_back`.
+        self._seq += 1
+        self._em_escrita[user_id] = (self._seq, state)
+        return user_id, self._seq, state
+
+    def _evict(self):
+        evicted = []
+        while len(self._entries) > self.capacity:
+            user_id, (state, dirty) = self._entries.popitem(last=False)
+            if dirty:
+                evicted.append(self._pendente(user_id, state))
+        return evicted
+
+    def _write_back(self, pending):
+        for user_id, seq, state in pending:
+            guarda = self._escritas.get(user_id)
+            guarda.acquire()
+            try:
+                with self._lock:
+                    atual = self._em_escrita.get(user_id)
+                if atual is None or atual[0] != seq:
+                    continue  # já escrita ou ultrapassada por uma escrita mais recente
+                if state is None:
+                    self.backend.delete(user_id)
+                else:
+                    self.backend.save(user_id, state)
+                with self._lock:
+                    if self._em_escrita.get(user_id, (None,))[0] == seq:
+                        del self._em_escrita[user_id]
+            finally:
+                guarda.release()
+
+    def flush(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or not entry[1]:
+                return
+            entry[1] = False
+            pending = [self._pendente(user_id, entry[0])]
+        self._write_back(pending)
+
+    def flush_all(self):
+        with self._lock:
+            pending = [self._pendente(user_id, entry[0]) for user_id, entry in self._entries.items() if entry[1]]
+            for entry in self._entries.values():
+                entry[1] = False
+        self._write_back(pending)
+
+    def keys(self):
+        self.flush_all()
+        return self.backend.keys()
+
+    def scan(self):
+        return self.backend.scan()
+
+    def count(self):
+        # Sem flush: conta o que está no backend (escritas pendentes podem ainda não estar lá).
+        return self.backend.count()
+
+    def stat(self, user_id):
+        self.flush(user_id)
+        return self.backend.stat(user_id)
+
+    def descartar(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and not entry[1]:
+                del self._entries[user_id]
+
+    def due_timers(self, agora):
+        return self.backend.due_timers(agora)
+
+    def save_message_id(self, message_id, seen_at):
+        return self.backend.save_message_id(message_id, seen_at)
+
+    def load_message_ids(self, since):
+        return self.backend.load_message_ids(since)
+
+    def forget_message_id(self, message_id):
+        self.backend.forget_message_id(message_id)
+
+def criar_state_store(backend=STATE_BACKEND, cache_size=STATE_CACHE_SIZE):
+    """Cria o StateStore configurado (`file` ou `sqlite`), com cache se `cache_size` > 0."""
+    if backend == 'sqlite':
+        store = SQLiteStateStore(STATE_DB)
+    elif backend == 'file':
+        store = FileStateStore(STATE_DIR)
+    else:
+        raise ValueError(f"Backend de estado desconhecido: {backend}")
+    if cache_size > 0:
+        store = CachedStateStore(store, cache_size)
+    return store
+
+if MULTIPROCESSO and STATE_BACKEND != 'sqlite':
+    raise RuntimeError("CHATBOT_MULTIPROCESSO=1 requer CHATBOT_STATE_BACKEND=sqlite")
+state_store = criar_state_store()
+atexit.register(lambda: state_store.flush_all())
+
+def get_user_state(user_id):
+    """Carrega o estado do utilizador (ou o estado inicial, se não existir)."""
+    state = state_store.get(user_id)
+    return state if state is not None else {'stage': 'start'}
 
 def save_user_state(user_id, state):
-    """Guarda o estado do utilizador num ficheiro JSON."""
-    filepath = os.path.join(STATE_DIR, f"{user_id}.json")
-    try:
-        with open(filepath, 'w') as f:
-            json.dump(state, f, indent=4)
-    except IOError as e:
-        logging.error(f"Erro ao guardar estado para {user_id}: {e}")
+    """Guarda o estado do utilizador."""
+    state_store.save(user_id, state)
 
 def delete_user_state(user_id):
-    """Apaga o ficheiro de estado de um utilizador."""
-    filepath = os.path.join(STATE_DIR, f"{user_id}.json")
-    if os.path.exists(filepath):
+    """Apaga o estado de um utilizador."""
+    state_store.delete(user_id)
+
+def migrar_estados(origem=STATE_DIR, destino=STATE_DB):
+    """Importa para o SQLite os ficheiros JSON de estado já existentes."""
+    ficheiros = FileStateStore(origem)
+    sqlite = SQLiteStateStore(destino)
+    importados = 0
+    for user_id in ficheiros.keys():
+        state = ficheiros.get(user_id)
+        if state is not None:
+            sqlite.save(user_id, state)
+            importados += 1
+    logging.info(f"{importados} estados importados de {origem} para {destino}.")
+    return importados
+
+
+# --- DEDUPLICAÇÃO DE MENSAGENS ---
+class MessageDedup:
+    """Índice limitado dos IDs de mensagem (data.key.id) recebidos recentemente.
+
+    Um OrderedDict por ordem de chegada: as entradas mais antigas que `ttl` ou além
+    de `capacidade` saem pela frente, por isso a memória fica limitada e cada
+    verificação é O(1). Com `store`, os IDs também são gravados no StateStore e os
+    recentes são recarregados no primeiro uso, para sobreviver a reinícios. Com
+    `partilhado` (modo multi-processo) é o registo no StateStore que decide se a
+    mensagem é nova, porque outro processo pode tê-la recebido.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, capacidade=DEDUP_MAX_IDS, store=None, partilhado=False):
+        self.ttl = ttl
+        self.capacidade = capacidade
+        self._store = store
+        self._partilhado = partilhado
+        self._ids = collections.OrderedDict()  # message_id -> instante em que foi visto
+        self._lock = threading.Lock()
+        self._carregado = store is None
+        self.stats = {'novas': 0, 'duplicadas': 0}
+
+    def _carregar(self):
+        agora = time.time()
         try:
-            os.remove(filepath)
-        except OSError as e:
-            logging.error(f"Erro ao apagar estado para {user_id}: {e}")
+            recentes = self._store.load_message_ids(agora - self.ttl)
+        except Exception as e:
+            logging.error(f"Erro ao carregar IDs de mensagens processadas: {e}")
+            recentes = []
+        with self._lock:
+            for message_id, seen_at in recentes:
+                self._ids[message_id] = seen_at
+            self._carregado = True
+            self._expirar(agora)
+
+    def _expirar(self, agora):
+        limite = agora - self.ttl
+        while self._ids:
+            message_id, seen_at = next(iter(self._ids.items()))
+            if seen_at >= limite and len(self._ids) <= self.capacidade:
+                break
+            self._ids.popitem(last=False)
+
+    def registar(self, message_id):
+        """Marca a mensagem como recebida. Devolve False se já tinha sido vista."""
+        if not self._carregado:
+            self._carregar()
+        agora = time.time()
+        with self._lock:
+            if message_id in self._ids:
+                self.stats['duplicadas'] += 1
+                return False
+            self._ids[message_id] = agora
+            self._expirar(agora)
+        if self._store is not None and not self._store.save_message_id(message_id, agora) and self._partilhado:
+            self.stats['duplicadas'] += 1
+            return False
+        self.stats['novas'] += 1
+        return True
+
+    def esquecer(self, message_id):
+        """Desfaz `registar` (por exemplo, quando a mensagem foi recusada e será reenviada)."""
+        with self._lock:
+            self._ids.pop(message_id, None)
+        if self._store is not None:
+            self._store.forget_message_id(message_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+if DEDUP_PERSISTENTE and STATE_BACKEND != 'sqlite':
+    raise RuntimeError("CHATBOT_DEDUP_PERSISTENTE=1 requer CHATBOT_STATE_BACKEND=sqlite")
+message_dedup = MessageDedup(store=state_store if DEDUP_PERSISTENTE or MULTIPROCESSO else None, partilhado=MULTIPROCESSO)
 
 
 # --- FUNÇÕES DO GOOGLE AGENDA ---
+CALENDAR_HTTP_POOL_SIZE = 8
+CALENDAR_HTTP_TIMEOUT = 15
+CALENDAR_REFRESH_MARGIN = 300  # segundos antes da expiração do token
+CALENDAR_RETRY_TENTATIVAS = 4
+CALENDAR_RETRY_BASE = 0.5
+CALENDAR_RETRY_STATUS = (429, 500, 502, 503, 504)
+CALENDAR_BATCH_MAX = 50  # pedidos por lote HTTP (o Google aceita até 1000, mas recomenda lotes pequenos)
 
-def get_calendar_service():
+class CalendarIndisponivel(Exception):
+    """O serviço do Google Agenda não pôde ser obtido (falha de autenticação)."""
+
+def _com_backoff(funcao, descricao, tentativas=CALENDAR_RETRY_TENTATIVAS, base=CALENDAR_RETRY_BASE):
+    """Executa `funcao` com um número limitado de tentativas e espera exponencial."""
+    for tentativa in range(tentativas):
+        try:
+            return funcao()
+        except Exception as e:
+            if tentativa == tentativas - 1:
+                raise
+            espera = base * (2 ** tentativa)
+            logging.warning(f"Falha ao {descricao} (tentativa {tentativa + 1}/{tentativas}): {e}. Nova tentativa em {espera:.1f}s.")
+            time.sleep(espera)
+
+def _erro_repetivel(erro):
+    """429/5xx, ou 403 por limite de quota (rateLimitExceeded/userRateLimitExceeded)."""
+    if not isinstance(erro, HttpError):
+        return False
+    status = erro.resp.status
+    if status in CALENDAR_RETRY_STATUS:
+        return True
+    return status == 403 and (b'rateLimitExceeded' in (erro.content or b'') or b'userRateLimitExceeded' in (erro.content or b''))
+
+def _espera_quota(erro, tentativa):
+    """Backoff exponencial com jitter, nunca abaixo do Retry-After devolvido pelo Google."""
+    espera = random.uniform(0, CALENDAR_RETRY_BASE * (2 ** tentativa))
+    retry_after = erro.resp.get('retry-after') if isinstance(erro, HttpError) else None
+    if retry_after and retry_after.isdigit():
+        espera = max(espera, float(retry_after))
+    return espera
+
+def _operacao(pedido):
+    # methodId do googleapiclient, p. ex. 'calendar.events.list' -> 'events.list'.
+    return (getattr(pedido, 'methodId', None) or 'desconhecida').removeprefix('calendar.')
+
+def _guardar_token(creds):
+    with open('token.json', 'w') as token:
+        token.write(creds.to_json())
+
+def _carregar_credenciais():
+    """Lê o token.json, atualizando-o ou pedindo nova autorização se necessário."""
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    if creds and creds.valid:
+        return creds
+    if creds and creds.expired and creds.refresh_token:
+        try:
+            _com_backoff(lambda: creds.refresh(Request()), "atualizar o token do Google")
+            _guardar_token(creds)
+            return creds
+        except Exception as e:
+            logging.error(f"Erro ao atualizar o token do Google: {e}")
+            if os.path.exists('token.json'): os.remove('token.json')
+    try:
+        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        creds = flow.run_local_server(port=0, open_browser=False)
+    except Exception as e:
+        logging.error(f"Ocorreu um erro durante o fluxo de autenticação: {e}")
+        return None
+    _guardar_token(creds)
+    return creds
+
+class CalendarClientManager:
+    """Cliente do Google Agenda partilhado por todo o processo.
+
+    O serviço é construído uma única vez e só quando alguma etapa da conversa
+    precisa dele. Os objetos httplib2 não são thread-safe, por isso cada pedido
+    usa um transporte autorizado emprestado de um pool. As credenciais são
+    atualizadas em segundo plano antes de expirarem.
+    """
+
+    def __init__(self, pool_size=CALENDAR_HTTP_POOL_SIZE):
+        self._lock = threading.Lock()
+        self._creds = None
+        self._service = None
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._refresher = None
+        self.stats = {'builds': 0, 'build_ms': 0.0, 'pedidos': 0}
+
+    def get_service(self):
+        """Devolve o serviço partilhado, construindo-o na primeira utilização."""
+        service = self._service
+        if service is not None:
+            return service
+        with self._lock:
+            if self._service is None:
+                inicio = time.perf_counter()
+                creds = _carregar_credenciais()
+                if not creds:
+                    raise CalendarIndisponivel("credenciais do Google indisponíveis")
+                try:
+                    service = build('calendar', 'v3', credentials=creds)
+                except HttpError as error:
+                    logging.error(f'Ocorreu um erro ao conectar ao Google Agenda: {error}')
+                    raise CalendarIndisponivel(str(error))
+                self._creds = creds
+                self._service = service
+                duracao_ms = (time.perf_counter() - inicio) * 1000
+                self.stats['builds'] += 1
+                self.stats['build_ms'] += duracao_ms
+                logging.info(f"Serviço do Google Agenda conectado com sucesso em {duracao_ms:.1f} ms.")
+                self._iniciar_refresher()
+            return self._service
+
+    def execute(self, pedido):
+        """Executa um pedido da API usando um transporte do pool; repete 429/5xx e limites de quota."""
+        operacao = _operacao(pedido)
+        for tentativa in range(CALENDAR_RETRY_TENTATIVAS):
+            http = self._emprestar_http()
+            inicio = time.perf_counter()
             try:
-                creds.refresh(Request())
+                self.stats['pedidos'] += 1
+                return pedido.execute(http=http)
             except Exception as e:
-                logging.error(f"Erro ao atualizar o token do Google: {e}")
-                if os.path.exists('token.json'): os.remove('token.json')
-                return get_calendar_service()
-        else:
+                METRICA_CALENDAR_ERROS.inc(operacao)
+                if not _erro_repetivel(e) or tentativa == CALENDAR_RETRY_TENTATIVAS - 1:
+                    raise
+                espera = _espera_quota(e, tentativa)
+                logging.warning(f"Google Agenda recusou {operacao} ({e.resp.status}); nova tentativa em {espera:.2f}s.")
+            finally:
+                METRICA_CALENDAR.observar(time.perf_counter() - inicio, operacao)
+                self._devolver_http(http)
+            time.sleep(espera)
+
+    def execute_batch(self, pedidos):
+        """Executa `pedidos` em lotes HTTP do Google (uma ida à rede por CALENDAR_BATCH_MAX pedidos).
+
+        Devolve [(resultado, erro)] pela ordem de `pedidos`. Só os pedidos que falharam
+        com 429/5xx ou por quota são repetidos, juntos num novo lote, com backoff.
+        """
+        resultados = [None] * len(pedidos)
+        erros = [None] * len(pedidos)
+        pendentes = list(range(len(pedidos)))
+        for tentativa in range(CALENDAR_RETRY_TENTATIVAS):
+            for inicio in range(0, len(pendentes), CALENDAR_BATCH_MAX):
+                self._executar_lote(pedidos, pendentes[inicio:inicio + CALENDAR_BATCH_MAX], resultados, erros)
+            pendentes = [i for i in pendentes if _erro_repetivel(erros[i])]
+            if not pendentes or tentativa == CALENDAR_RETRY_TENTATIVAS - 1:
+                break
+            espera = max(_espera_quota(erros[i], tentativa) for i in pendentes)
+            logging.warning(f"Google Agenda recusou {len(pendentes)} pedidos do lote; nova tentativa em {espera:.2f}s.")
+            time.sleep(espera)
+        return list(zip(resultados, erros))
+
+    def _executar_lote(self, pedidos, indices, resultados, erros):
+        def concluido(request_id, resposta, excecao):
+            i = int(request_id)
+            resultados[i], erros[i] = resposta, excecao
+            if excecao is not None:
+                METRICA_CALENDAR_ERROS.inc(_operacao(pedidos[i]))
+
+        lote = self.get_service().new_batch_http_request(callback=concluido)
+        for i in indices:
+            lote.add(pedidos[i], request_id=str(i))
+        http = self._emprestar_http()
+        inicio = time.perf_counter()
+        try:
+            self.stats['pedidos'] += 1
+            lote.execute(http=http)
+        except Exception as e:
+            # Falhou o próprio lote (ligação ou 5xx do endpoint de batch): falharam todos os pedidos.
+            METRICA_CALENDAR_ERROS.inc('batch')
+            for i in indices:
+                resultados[i], erros[i] = None, e
+        finally:
+            METRICA_CALENDAR.observar(time.perf_counter() - inicio, 'batch')
+            self._devolver_http(http)
+
+    def _emprestar_http(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return AuthorizedHttp(self._creds, http=httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT))
+
+    def _devolver_http(self, http):
+        try:
+            self._pool.put_nowait(http)
+        except queue.Full:
+            pass
+
+    def _iniciar_refresher(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="calendar-refresh", daemon=True)
+            self._refresher.start()
+
+    def _segundos_ate_refresh(self):
+        expiry = self._creds.expiry
+        if not expiry:
+            return CALENDAR_REFRESH_MARGIN
+        agora = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return max((expiry - agora).total_seconds() - CALENDAR_REFRESH_MARGIN, 5)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self._segundos_ate_refresh())
             try:
-                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-                creds = flow.run_local_server(port=0, open_browser=False)
+                # As credenciais são partilhadas pelos transportes do pool, que passam a usar o novo token.
+                with self._lock:
+                    _com_backoff(lambda: self._creds.refresh(Request()), "atualizar o token do Google")
+                    _guardar_token(self._creds)
+                logging.info("Token do Google atualizado em segundo plano.")
             except Exception as e:
-                logging.error(f"Ocorreu um erro durante o fluxo de autenticação: {e}")
-                return None
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+                logging.error(f"Erro ao atualizar o token do Google em segundo plano: {e}")
+                time.sleep(60)
+
+calendar_client = CalendarClientManager()
+
+def get_calendar_service():
+    """Devolve o serviço partilhado do Google Agenda, ou None se a autenticação falhar."""
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        logging.info("Serviço do Google Agenda conectado com sucesso.")
-        return service
-    except HttpError as error:
-        logging.error(f'Ocorreu um erro ao conectar ao Google Agenda: {error}')
+        return calendar_client.get_service()
+    except CalendarIndisponivel:
         return None
 
+# --- CACHE DE DISPONIBILIDADE ---
+AVAILABILITY_CACHE_TTL = 60  # segundos
+
+class _Voo:
+    """Uma leitura em curso, partilhada pelos pedidos que falharam a cache ao mesmo tempo."""
+    __slots__ = ('evento', 'resultado', 'erro')
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+class AvailabilityCache:
+    """Horários livres partilhados por todos os utilizadores durante `ttl` segundos.
+
+    Falhas simultâneas da cache esperam por uma única leitura ao Google (single-flight).
+    A cache é invalidada sempre que um evento é criado ou apagado com sucesso; uma
+    leitura que estivesse em curso nesse momento não volta a ser guardada.
+    """
+
+    def __init__(self, ttl=AVAILABILITY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._valor = None
+        self._expira = 0.0
+        self._geracao = 0
+        self._voo = None
+        self.stats = {'hits': 0, 'misses': 0, 'leituras': 0, 'invalidacoes': 0}
+
+    def get(self, carregar):
+        """Devolve os horários em cache ou obtém-nos com `carregar()`."""
+        with self._lock:
+            if self._valor is not None and time.monotonic() < self._expira:
+                self.stats['hits'] += 1
+                return list(self._valor)
+            self.stats['misses'] += 1
+            voo = self._voo
+            if voo is not None:
+                dono = False
+            else:
+                voo = self._voo = _Voo()
+                dono = True
+                geracao = self._geracao
+                self.stats['leituras'] += 1
+
+        if not dono:
+            voo.evento.wait()
+            if voo.erro is not None:
+                raise voo.erro
+            return list(voo.resultado)
+
+        resultado = []
+        try:
+            resultado = carregar()
+        except Exception as e:
+            voo.erro = e
+            raise
+        finally:
+            with self._lock:
+                self._voo = None
+                # Uma lista vazia pode ser um erro da API, por isso não fica em cache.
+                if resultado and geracao == self._geracao:
+                    self._valor = resultado
+                    self._expira = time.monotonic() + self.ttl
+            voo.resultado = resultado
+            voo.evento.set()
+        return list(resultado)
+
+    def invalidate(self):
+        with self._lock:
+            self._valor = None
+            self._geracao += 1
+            self.stats['invalidacoes'] += 1
+
+availability_cache = AvailabilityCache()
+
+# --- ÍNDICE LOCAL DE EVENTOS POR UTILIZADOR ---
+EVENT_INDEX_SYNC_INTERVAL = 300  # segundos entre sincronizações incrementais
+
+def _jid_do_evento(evento):
+    """O remoteJid de um evento do chatbot (propriedade privada ou, nos antigos, a descrição)."""
+    jid = evento.get('extendedProperties', {}).get('private', {}).get('remoteJid')
+    if jid:
+        return jid
+    encontrado = re.search(r"Cliente: (\S+)", evento.get('description') or '')
+    return encontrado.group(1) if encontrado else None
+
+class UserEventIndex:
+    """remoteJid -> consultas futuras, mantido em memória.
+
+    Alimentado por create/delete_calendar_event e reconciliado periodicamente com a
+    sincronização incremental do Google Agenda (syncToken). Com o índice frio, a
+    primeira consulta faz uma leitura completa da agenda.
+    """
+
+    def __init__(self, intervalo=EVENT_INDEX_SYNC_INTERVAL):
+        self.intervalo = intervalo
+        self._por_jid = {}  # jid -> {event_id: evento resumido}
+        self._jid_por_evento = {}
+        self._sync_token = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _resumo(evento):
+        return {
+            'id': evento['id'],
+            'summary': evento.get('summary', ''),
+            'description': evento.get('description', ''),  # para repor a consulta se uma remarcação falhar
+            'start': {'dateTime': evento['start']['dateTime']},
+            'end': {'dateTime': evento.get('end', {}).get('dateTime')},
+        }
+
+    def _remover(self, event_id):
+        jid = self._jid_por_evento.pop(event_id, None)
+        if jid is not None:
+            eventos = self._por_jid.get(jid, {})
+            eventos.pop(event_id, None)
+            if not eventos:
+                self._por_jid.pop(jid, None)
+
+    def _aplicar(self, evento, agora, user_id=None):
+        self._remover(evento['id'])
+        if evento.get('status') == 'cancelled' or not evento.get('start', {}).get('dateTime'):
+            return
+        if _parse_rfc3339(evento['start']['dateTime']) < agora:
+            return
+        jid = user_id or _jid_do_evento(evento)
+        if jid:
+            self._por_jid.setdefault(jid, {})[evento['id']] = self._resumo(evento)
+            self._jid_por_evento[evento['id']] = jid
+
+    def adicionar(self, evento, user_id=None):
+        with self._lock:
+            self._aplicar(evento, datetime.datetime.now(datetime.timezone.utc), user_id)
+
+    def remover(self, event_id):
+        with self._lock:
+            self._remover(event_id)
+
+    def proximo(self, user_id):
+        """A próxima consulta do utilizador, ou None."""
+        agora = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            futuros = [e for e in self._por_jid.get(user_id, {}).values() if _parse_rfc3339(e['start']['dateTime']) >= agora]
+        return min(futuros, key=lambda e: _parse_rfc3339(e['start']['dateTime'])) if futuros else None
+
+    def pronto(self):
+        return self._sync_token is not None
+
+    def garantir(self, service):
+        """Faz a leitura completa se o índice ainda estiver frio."""
+        if not self.pronto():
+            self.sincronizar(service)
+
+    def _listar(self, service, sync_token):
+        kwargs = {'calendarId': CALENDAR_ID, 'maxResults': 2500}
+        if sync_token:
+            kwargs['syncToken'] = sync_token
+        itens, pagina = [], None
+        while True:
+            resultado = calendar_client.execute(service.events().list(pageToken=pagina, **kwargs))
+            itens.extend(resultado.get('items', []))
+            pagina = resultado.get('nextPageToken')
+            if not pagina:
+                return itens, resultado.get('nextSyncToken')
+
+    def sincronizar(self, service):
+        """Sincronização incremental; completa se não houver token ou se o Google o invalidar (410)."""
+        with self._sync_lock:
+            token = self._sync_token
+            try:
+                itens, novo_token = self._listar(service, token)
+            except HttpError as error:
+                if token is None or error.resp.status != 410:
+                    raise
+                logging.info("syncToken do Google Agenda expirado; a reconstruir o índice de eventos.")
+                token = None
+                itens, novo_token = self._listar(service, None)
+            agora = datetime.datetime.now(datetime.timezone.utc)
+            with self._lock:
+                anteriores = set(self._jid_por_evento) if token is None else set()
+                for evento in itens:
+                    self._aplicar(evento, agora)
+                # Numa leitura completa, o que já não existe na agenda sai do índice.
+                for event_id in anteriores - {evento['id'] for evento in itens}:
+                    self._remover(event_id)
+                # Consultas que já passaram deixam de interessar.
+                for event_id, jid in list(self._jid_por_evento.items()):
+                    if _parse_rfc3339(self._por_jid[jid][event_id]['start']['dateTime']) < agora:
+                        self._remover(event_id)
+                self._sync_token = novo_token
+            if token is None:
+                logging.info(f"Índice de eventos reconstruído: {len(self._jid_por_evento)} consultas futuras.")
+        self._iniciar_sync_periodica()
+
+    def _iniciar_sync_periodica(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sync_loop, name="event-index-sync", daemon=True)
+            self._thread.start()
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.sincronizar(calendar_client.get_service())
+            except Exception as e:
+                logging.error(f"Erro na sincronização do índice de eventos: {e}")
+
+user_event_index = UserEventIndex()
+
 def find_user_event(service, user_id):
-    now_utc = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
-        events_result = service.events().list(
-            calendarId=CALENDAR_ID, timeMin=now_utc,
-            q=user_id, maxResults=1, singleEvents=True, orderBy='startTime'
-        ).execute()
-        return events_result.get('items', [])
+        user_event_index.garantir(service)
     except Exception as e:
         logging.error(f"Erro ao procurar evento para {user_id}: {e}")
         return None
+    evento = user_event_index.proximo(user_id)
+    if evento is None and MULTIPROCESSO:
+        # A consulta pode ter sido marcada noutro processo desde a última sincronização.
+        try:
+            user_event_index.sincronizar(service)
+        except Exception as e:
+            logging.error(f"Erro ao procurar evento para {user_id}: {e}")
+            return None
+        evento = user_event_index.proximo(user_id)
+    return [evento] if evento else []
 
-def get_available_slots(service):
+# --- MOTOR DE HORÁRIOS ---
+def _parse_rfc3339(valor):
+    return datetime.datetime.fromisoformat(valor.replace('Z', '+00:00'))
+
+class BusyIntervals:
+    """Intervalos ocupados, ordenados e fundidos, consultados por bisect."""
+
+    def __init__(self, intervalos):
+        starts, ends = [], []
+        for start, end in sorted(intervalos):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self._starts = starts
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._starts)
+
+    def is_free(self, start, end):
+        """True se [start, end) não se sobrepõe a nenhum intervalo ocupado."""
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i >= 0 and self._ends[i] > start:
+            return False
+        return i + 1 >= len(self._starts) or self._starts[i + 1] >= end
+
+def candidate_slots(now_utc, working_hours=SLOT_WORKING_HOURS, duration=SLOT_DURATION, horizon_days=SLOT_HORIZON_DAYS, tz=SLOT_TIMEZONE):
+    """Gera, por ordem, os (início, fim) dos horários de consulta dos próximos dias."""
+    hoje = now_utc.astimezone(tz).date()
+    for day_offset in range(1, horizon_days + 1):
+        day = hoje + datetime.timedelta(days=day_offset)
+        for slot_time in working_hours:
+            start = datetime.datetime.combine(day, slot_time, tzinfo=tz).astimezone(datetime.timezone.utc)
+            if start >= now_utc:
+                yield start, start + duration
+
+def compute_free_slots(busy, now_utc, limit=SLOT_MAX_OFFERED, **config):
+    """Os primeiros `limit` horários livres segundo `busy` (um BusyIntervals); todos se `limit` for None."""
     available_slots = []
+    for start, end in candidate_slots(now_utc, **config):
+        if busy.is_free(start, end):
+            available_slots.append(start)
+            if limit is not None and len(available_slots) >= limit:
+                break
+    return available_slots
+
+def get_busy_intervals(service, time_min, time_max):
+    """Lê os intervalos ocupados da agenda através da API FreeBusy."""
+    body = {'timeMin': time_min.isoformat(), 'timeMax': time_max.isoformat(), 'items': [{'id': CALENDAR_ID}]}
+    result = calendar_client.execute(service.freebusy().query(body=body))
+    calendario = result.get('calendars', {}).get(CALENDAR_ID, {})
+    if calendario.get('errors'):
+        raise RuntimeError(f"FreeBusy devolveu erros: {calendario['errors']}")
+    return BusyIntervals((_parse_rfc3339(b['start']), _parse_rfc3339(b['end'])) for b in calendario.get('busy', []))
+
+def get_available_slots(service):
     now_utc = datetime.datetime.now(datetime.timezone.utc)
-    time_min = now_utc.isoformat()
-    time_max = (now_utc + datetime.timedelta(days=14)).isoformat()
+    # Um dia a mais cobre os horários do último dia que terminam depois de now + horizonte.
+    time_max = now_utc + datetime.timedelta(days=SLOT_HORIZON_DAYS + 1)
     try:
-        events_result = service.events().list(
-            calendarId=CALENDAR_ID, timeMin=time_min, timeMax=time_max,
-            singleEvents=True, orderBy='startTime'
-        ).execute()
+        busy = get_busy_intervals(service, now_utc, time_max)
     except Exception as e:
         logging.error(f"Erro ao buscar eventos na agenda: {e}")
         return []
-    busy_slots = events_result.get('items', [])
-    working_hours = [datetime.time(9, 0), datetime.time(10, 30), datetime.time(15, 0), datetime.time(16, 30)]
-    for day_offset in range(1, 15):
-        day = (now_utc + datetime.timedelta(days=day_offset)).date()
-        for slot_time in working_hours:
-            slot_datetime_utc = datetime.datetime.combine(day, slot_time).replace(tzinfo=datetime.timezone.utc)
-            if slot_datetime_utc < now_utc: continue
-            is_busy = False
-            for event in busy_slots:
-                start_utc = datetime.datetime.fromisoformat(event['start'].get('dateTime'))
-                end_utc = datetime.datetime.fromisoformat(event['end'].get('dateTime'))
-                if start_utc <= slot_datetime_utc < end_utc:
-                    is_busy = True
-                    break
-            if not is_busy: available_slots.append(slot_datetime_utc)
-            if len(available_slots) >= 5: return available_slots
-    return available_slots
+    # Todos os horários livres do horizonte: os primeiros podem estar reservados para outros utilizadores.
+    return compute_free_slots(busy, now_utc, limit=None, working_hours=SLOT_WORKING_HOURS, duration=SLOT_DURATION,
+                              horizon_days=SLOT_HORIZON_DAYS, tz=SLOT_TIMEZONE)
 
-def create_calendar_event(service, summary, start_time, end_time, description):
+def _corpo_evento(summary, start_time, end_time, description, user_id=None):
+    # ID gerado aqui (base32hex aceita os dígitos hexadecimais) e igual em todas as tentativas:
+    # se a resposta a um insert se perder, a repetição recebe 409 em vez de criar uma segunda consulta.
     event = {
+        'id': uuid.uuid4().hex,
         'summary': summary, 'description': description,
         'start': {'dateTime': start_time.isoformat(), 'timeZone': 'America/Sao_Paulo'},
         'end': {'dateTime': end_time.isoformat(), 'timeZone': 'America/Sao_Paulo'},
     }
+    if user_id:
+        event['extendedProperties'] = {'private': {'remoteJid': user_id}}
+    return event
+
+def _ja_criado(erro):
+    # 409 num insert com o nosso ID: uma tentativa anterior já criou o evento.
+    return isinstance(erro, HttpError) and erro.resp.status == 409
+
+def create_calendar_event(service, summary, start_time, end_time, description, user_id=None):
+    """Cria o evento e devolve-o (ou None em caso de erro)."""
+    event = _corpo_evento(summary, start_time, end_time, description, user_id)
     try:
-        created_event = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+        try:
+            created_event = calendar_client.execute(service.events().insert(calendarId=CALENDAR_ID, body=event))
+        except HttpError as error:
+            if not _ja_criado(error):
+                raise
+            created_event = event
         logging.info(f"Evento criado: {created_event.get('htmlLink')}")
-        return True
+        availability_cache.invalidate()
+        user_event_index.adicionar(created_event, user_id)
+        return created_event
     except HttpError as error:
         logging.error(f"Não foi possível criar o evento: {error}")
-        return False
+        return None
+
+def _ja_apagado(erro):
+    return erro is None or (isinstance(erro, HttpError) and erro.resp.status in (404, 410))
 
 def delete_calendar_event(service, event_id):
     try:
-        service.events().delete(calendarId=CALENDAR_ID, eventId=event_id).execute()
+        calendar_client.execute(service.events().delete(calendarId=CALENDAR_ID, eventId=event_id))
         logging.info(f"Evento {event_id} apagado com sucesso.")
-        return True
     except HttpError as error:
-        logging.error(f"Não foi possível apagar o evento {event_id}: {error}")
-        return False
+        if not _ja_apagado(error):
+            logging.error(f"Não foi possível apagar o evento {event_id}: {error}")
+            return False
+        # O índice local pode estar atrasado: o evento já tinha sido apagado no Google.
+        logging.info(f"Evento {event_id} já não existia na agenda.")
+    availability_cache.invalidate()
+    user_event_index.remover(event_id)
+    return True
+
+def reschedule_calendar_event(service, antigo, summary, start_time, end_time, description, user_id=None):
+    """Cria o novo evento e apaga `antigo` no mesmo lote HTTP.
+
+    Devolve (novo evento ou None, antigo apagado). Os pedidos de um lote não são
+    transacionais: se só a criação falhar, a consulta antiga é reposta.
+    """
+    event = _corpo_evento(summary, start_time, end_time, description, user_id)
+    (criado, erro_criar), (_, erro_apagar) = calendar_client.execute_batch([
+        service.events().insert(calendarId=CALENDAR_ID, body=event),
+        service.events().delete(calendarId=CALENDAR_ID, eventId=antigo['id']),
+    ])
+    if _ja_criado(erro_criar):
+        criado, erro_criar = event, None
+    apagado = _ja_apagado(erro_apagar)
+    if apagado:
+        user_event_index.remover(antigo['id'])
+    else:
+        logging.error(f"Não foi possível apagar o evento {antigo['id']}: {erro_apagar}")
+    if erro_criar is not None:
+        logging.error(f"Não foi possível criar o evento: {erro_criar}")
+        if apagado and erro_apagar is None:
+            reposto = create_calendar_event(service, antigo.get('summary', ''), _parse_rfc3339(antigo['start']['dateTime']),
+                                            _parse_rfc3339(antigo['end']['dateTime']),
+                                            antigo.get('description') or "Consulta reposta após falha na remarcação.", user_id)
+            logging.warning(f"Consulta {antigo['id']} de {user_id} reposta como {reposto and reposto.get('id')}.")
+        availability_cache.invalidate()
+        return None, False
+    logging.info(f"Evento remarcado: {antigo['id']} -> {criado.get('id')} ({criado.get('htmlLink')})")
+    availability_cache.invalidate()
+    user_event_index.adicionar(criado, user_id)
+    return criado, apagado
+
+def cancel_events_on_day(dia, confirmar=False):
+    """Apaga, em lotes, as consultas marcadas pelo chatbot no `dia` (hora de Brasília). Devolve (encontradas, apagadas).
+
+    Sem `confirmar` apenas lista o que seria apagado.
+    """
+    service = calendar_client.get_service()
+    fuso = datetime.timezone(datetime.timedelta(hours=-3))
+    inicio = datetime.datetime.combine(dia, datetime.time(0, 0), tzinfo=fuso)
+    eventos, pagina = [], None
+    while True:
+        resultado = calendar_client.execute(service.events().list(
+            calendarId=CALENDAR_ID, timeMin=inicio.isoformat(), timeMax=(inicio + datetime.timedelta(days=1)).isoformat(),
+            singleEvents=True, maxResults=2500, pageToken=pagina))
+        eventos.extend(e for e in resultado.get('items', []) if e.get('status') != 'cancelled' and _jid_do_evento(e))
+        pagina = resultado.get('nextPageToken')
+        if not pagina:
+            break
+    for evento in eventos:
+        logging.info(f"{evento['start'].get('dateTime')} {evento.get('summary', '')} ({_jid_do_evento(evento)}, {evento['id']})")
+    if not confirmar or not eventos:
+        logging.info(f"{len(eventos)} consultas do chatbot em {dia.isoformat()}" + ("" if confirmar else "; use --confirmar para as apagar."))
+        return len(eventos), 0
+    respostas = calendar_client.execute_batch([service.events().delete(calendarId=CALENDAR_ID, eventId=e['id']) for e in eventos])
+    apagadas = 0
+    for evento, (_, erro) in zip(eventos, respostas):
+        if _ja_apagado(erro):
+            apagadas += 1
+            user_event_index.remover(evento['id'])
+        else:
+            logging.error(f"Não foi possível apagar o evento {evento['id']}: {erro}")
+    availability_cache.invalidate()
+    logging.info(f"{apagadas} de {len(eventos)} consultas do chatbot em {dia.isoformat()} apagadas.")
+    return len(eventos), apagadas
+
+# --- RESERVAS DE HORÁRIOS ---
+# Resultado de reservar um único horário (ambos verdadeiros; False se outro utilizador o detiver).
+RESERVA_RENOVADA = 'renovada'  # o utilizador já tinha a reserva em vigor
+RESERVA_RETOMADA = 'retomada'  # a reserva não existia ou tinha expirado: o horário pode ter sido marcado entretanto
+
+class SQLiteSlotHoldStore:
+    """Reservas de horários numa tabela SQLite (a base de `CHATBOT_STATE_DB`), partilhadas entre processos.
+
+    Os instantes `expira` e `agora` são passados por SlotHolds; uma reserva expirada
+    é tratada como inexistente e apagada de tempos a tempos.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS slot_holds ("
+                "slot TEXT PRIMARY KEY, user_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS slot_holds_user_id ON slot_holds (user_id)")
+        self._ofertas = 0
+
+    def _conn(self):
+        return _ligacao_sqlite(self._local, self.path)
+
+    # Fica com o horário se estiver livre, se a reserva for do próprio ou se já tiver expirado.
+    _RESERVAR = (
+        "INSERT INTO slot_holds (slot, user_id, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(slot) DO UPDATE SET user_id = excluded.user_id, expires_at = excluded.expires_at "
+        "WHERE slot_holds.user_id = excluded.user_id OR slot_holds.expires_at <= ?"
+    )
+
+    def hold_slots(self, user_id, slots, limite, expira, agora):
+        """Troca as reservas de `user_id` pelos primeiros `limite` de `slots` livres em `agora`. Devolve-os."""
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM slot_holds WHERE user_id = ?", (user_id,))
+                escolhidos = []
+                for slot in slots:
+                    if len(escolhidos) >= limite:
+                        break
+                    if conn.execute(self._RESERVAR, (slot, user_id, expira, agora)).rowcount == 1:
+                        escolhidos.append(slot)
+                self._ofertas += 1
+                if self._ofertas % 1000 == 0:
+                    conn.execute("DELETE FROM slot_holds WHERE expires_at <= ?", (agora,))
+                return escolhidos
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao reservar horários para {user_id}: {e}")
+            return list(slots[:limite])
+
+    def hold_slot(self, user_id, slot, expira, agora):
+        """Deixa `user_id` só com `slot` reservado, se estiver livre ou já for dele.
+
+        Devolve RESERVA_RENOVADA ou RESERVA_RETOMADA, ou False se outro utilizador o detiver.
+        """
+        try:
+            with self._conn() as conn:
+                em_vigor = conn.execute(
+                    "SELECT 1 FROM slot_holds WHERE slot = ? AND user_id = ? AND expires_at > ?", (slot, user_id, agora)
+                ).fetchone() is not None
+                if conn.execute(self._RESERVAR, (slot, user_id, expira, agora)).rowcount != 1:
+                    return False
+                conn.execute("DELETE FROM slot_holds WHERE user_id = ? AND slot != ?", (user_id, slot))
+                return RESERVA_RENOVADA if em_vigor else RESERVA_RETOMADA
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao reservar o horário {slot} para {user_id}: {e}")
+            return RESERVA_RETOMADA  # sem garantias: quem chama verifica na agenda
+
+    def release_slots(self, user_id):
+        """Liberta todas as reservas de `user_id`."""
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM slot_holds WHERE user_id = ?", (user_id,))
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao libertar as reservas de {user_id}: {e}")
+
+class SlotHolds:
+    """Reservas temporárias dos horários oferecidos (ISO 8601 em UTC).
+
+    Cada horário tem no máximo um dono até a reserva expirar. Um utilizador só
+    recebe horários livres ou já seus, e quem escolhe um horário fica só com esse;
+    na confirmação a reserva é verificada outra vez, atomicamente, antes de criar o
+    evento. Assim utilizadores em simultâneo nunca recebem nem marcam o mesmo
+    horário sem ser preciso voltar a consultar o Google. Com `store` (um
+    SQLiteSlotHoldStore) as reservas sobrevivem a reinícios e são partilhadas entre
+    processos.
+    """
+
+    def __init__(self, ttl=SLOT_HOLD_TTL, store=None):
+        self.ttl = ttl
+        self.ttl_confirmada = SLOT_HOLD_CONFIRMADA_TTL
+        self._store = store
+        self._reservas = {}  # slot -> (user_id, expira)
+        self._por_utilizador = {}  # user_id -> {slot, ...}
+        self._lock = threading.Lock()
+        self._ofertas = 0
+        self.stats = {'ofertas': 0, 'conflitos': 0}
+
+    def _livre(self, slot, user_id, agora):
+        reserva = self._reservas.get(slot)
+        return reserva is None or reserva[0] == user_id or reserva[1] <= agora
+
+    def _reservar(self, user_id, slot, expira):
+        anterior = self._reservas.get(slot)
+        if anterior is not None and anterior[0] != user_id:
+            self._soltar(anterior[0], slot)
+        self._reservas[slot] = (user_id, expira)
+        self._por_utilizador.setdefault(user_id, set()).add(slot)
+
+    def _soltar(self, user_id, slot):
+        slots = self._por_utilizador.get(user_id)
+        if slots is not None:
+            slots.discard(slot)
+            if not slots:
+                del self._por_utilizador[user_id]
+
+    def _libertar(self, user_id, exceto=None):
+        for slot in self._por_utilizador.pop(user_id, set()) - {exceto}:
+            if self._reservas.get(slot, (None,))[0] == user_id:
+                del self._reservas[slot]
+        if exceto is not None:
+            self._por_utilizador[user_id] = {exceto}
+
+    def _expirar(self, agora):
+        for slot, (user_id, expira) in list(self._reservas.items()):
+            if expira <= agora:
+                del self._reservas[slot]
+                self._soltar(user_id, slot)
+
+    def oferecer(self, user_id, slots, limite=SLOT_MAX_OFFERED):
+        """Reserva para `user_id` os primeiros `limite` horários livres de `slots`, no lugar das reservas anteriores."""
+        agora = time.time()
+        self.stats['ofertas'] += 1
+        if self._store is not None:
+            return self._store.hold_slots(user_id, slots, limite, agora + self.ttl, agora)
+        with self._lock:
+            self._ofertas += 1
+            if self._ofertas % 1000 == 0:
+                self._expirar(agora)
+            self._libertar(user_id)
+            escolhidos = []
+            for slot in slots:
+                if len(escolhidos) >= limite:
+                    break
+                if self._livre(slot, user_id, agora):
+                    self._reservar(user_id, slot, agora + self.ttl)
+                    escolhidos.append(slot)
+            return escolhidos
+
+    def reservar(self, user_id, slot, ttl=None):
+        """Deixa `user_id` só com `slot` reservado. Devolve False se outro utilizador o tiver reservado.
+
+        Caso contrário devolve RESERVA_RENOVADA se a reserva de `user_id` ainda estava em
+        vigor, ou RESERVA_RETOMADA se tinha expirado (ou se perdeu num reinício): nesse
+        intervalo o horário pode ter sido marcado por outra pessoa, e só a agenda o diz.
+        """
+        agora = time.time()
+        expira = agora + (self.ttl if ttl is None else ttl)
+        if self._store is not None:
+            reservado = self._store.hold_slot(user_id, slot, expira, agora)
+        else:
+            with self._lock:
+                reserva = self._reservas.get(slot)
+                if not self._livre(slot, user_id, agora):
+                    reservado = False
+                elif reserva is not None and reserva[0] == user_id and reserva[1] > agora:
+                    reservado = RESERVA_RENOVADA
+                else:
+                    reservado = RESERVA_RETOMADA
+                if reservado:
+                    self._reservar(user_id, slot, expira)
+                    self._libertar(user_id, exceto=slot)
+        if not reservado:
+            self.stats['conflitos'] += 1
+        return reservado
+
+    def libertar(self, user_id):
+        """Liberta as reservas de `user_id` (conversa terminada, cancelada ou abandonada)."""
+        if self._store is not None:
+            self._store.release_slots(user_id)
+            return
+        with self._lock:
+            self._libertar(user_id)
+
+    def __len__(self):
+        return len(self._reservas)
+
+slot_holds = SlotHolds(store=SQLiteSlotHoldStore(STATE_DB) if SLOT_HOLD_PERSISTENTE or MULTIPROCESSO else None)
 
 # --- LÓGICA DE INATIVIDADE ---
-def handle_inactivity(user_id, dados_originais, timer_id):
-    logging.info(f"[Timer] Iniciando temporizador de 90s para {user_id} (ID: {timer_id})")
-    time.sleep(90)
+INACTIVITY_PROMPT_DELAY = 90
+INACTIVITY_CLOSE_DELAY = 30
+INACTIVITY_WORKERS = 4
+INACTIVITY_POLL_INTERVAL = 1.0  # modo multi-processo
+INACTIVITY_ELECTION_INTERVAL = 5.0
 
-    with user_states_lock:
-        state = get_user_state(user_id)
-        if not state or state.get('timer_id') != timer_id:
-            logging.info(f"[Timer] Timer {timer_id} para {user_id} cancelado.")
+def contexto_envio(dados):
+    """Extrai do payload do webhook apenas o necessário para responder (instância, jid, apikey)."""
+    return {
+        'instance': dados.get('instance'),
+        'apikey': dados.get('apikey'),
+        'data': {'key': {'remoteJid': dados.get('data', {}).get('key', {}).get('remoteJid')}},
+    }
+
+class InactivityScheduler:
+    """Uma única thread para os temporizadores de inatividade de todos os utilizadores.
+
+    Os prazos vivem num heap. Cada utilizador tem no máximo um temporizador ativo em
+    `_pendentes`, por isso cancelar é O(1) e reagendar apenas substitui essa entrada;
+    as entradas antigas do heap são descartadas quando chegam ao topo. Os disparos
+    correm num pequeno pool para que um envio lento não atrase os outros prazos.
+    """
+
+    def __init__(self, callback, workers=INACTIVITY_WORKERS):
+        self._callback = callback
+        self._heap = []
+        self._pendentes = {}  # user_id -> (deadline, timer_id, fase, contexto)
+        self._cond = threading.Condition()
+        self._workers = workers
+        self._executor = None
+        self._thread = None
+
+    def start(self, store=None):
+        """Inicia a thread do agendador, recuperando os prazos guardados em `store`."""
+        if self._thread is not None:
             return
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="inatividade")
+            self._thread = threading.Thread(target=self._run, args=(store,), name="inactivity-scheduler", daemon=True)
+            self._thread.start()
 
-        state['stage'] = 'awaiting_inactivity_response'
-        save_user_state(user_id, state)
-    
-    inactivity_prompt = "Olá! Notei que não interagimos há um tempo. Você ainda precisa de ajuda?\n\n1. Sim\n2. Não"
-    enviar_resposta_api(dados_originais, inactivity_prompt)
+    def schedule(self, user_id, deadline, timer_id, fase, contexto):
+        with self._cond:
+            self._pendentes[user_id] = (deadline, timer_id, fase, contexto)
+            heapq.heappush(self._heap, (deadline, user_id, timer_id))
+            self._cond.notify()
+
+    def cancel(self, user_id):
+        with self._cond:
+            self._pendentes.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._pendentes)
 
-    logging.info(f"[Timer] Iniciando temporizador final de 30s para {user_id}")
-    time.sleep(30)
+    def _recuperar(self, store):
+        recuperados = 0
+        for user_id in store.keys():
+            state = store.get(user_id)
+            if state and state.get('timer_id') and state.get('timer_deadline'):
+                with self._cond:
+                    if user_id not in self._pendentes:
+                        self._pendentes[user_id] = (state['timer_deadline'], state['timer_id'], state.get('timer_fase', 'aviso'), state.get('envio'))
+                        heapq.heappush(self._heap, (state['timer_deadline'], user_id, state['timer_id']))
+                        recuperados += 1
+        if recuperados:
+            logging.info(f"[Timer] {recuperados} temporizadores de inatividade recuperados.")
 
-    with user_states_lock:
+    def _proximo(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, user_id, timer_id = self._heap[0]
+                atraso = deadline - time.time()
+                if atraso > 0:
+                    self._cond.wait(atraso)
+                    continue
+                heapq.heappop(self._heap)
+                entry = self._pendentes.get(user_id)
+                if entry is not None and entry[0] == deadline and entry[1] == timer_id:
+                    del self._pendentes[user_id]
+                    return user_id, entry
+
+    def _run(self, store):
+        if store is not None:
+            try:
+                self._recuperar(store)
+            except Exception as e:
+                logging.error(f"[Timer] Erro ao recuperar temporizadores: {e}")
+        while True:
+            user_id, (deadline, timer_id, fase, contexto) = self._proximo()
+            self._executor.submit(self._disparar, user_id, timer_id, fase, contexto)
+
+    def _disparar(self, user_id, timer_id, fase, contexto):
+        try:
+            self._callback(user_id, timer_id, fase, contexto)
+        except Exception as e:
+            logging.error(f"[Timer] Erro no temporizador de {user_id}: {e}")
+
+class SharedInactivitySweeper:
+    """Temporizadores de inatividade no modo multi-processo.
+
+    Os prazos vivem só no StateStore partilhado. Os processos disputam um flock e
+    apenas o eleito consulta os prazos vencidos e dispara `callback`; os restantes
+    continuam a tentar, para assumir se o eleito terminar (o sistema operativo
+    liberta o flock). `schedule` e `cancel` não fazem nada: o estado gravado basta.
+    """
+
+    def __init__(self, callback, lock_path, workers=INACTIVITY_WORKERS):
+        self._callback = callback
+        self._lock_path = lock_path
+        self._workers = workers
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._em_curso = set()
+        self.lider = False
+
+    def start(self, store=None):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="inatividade")
+            self._thread = threading.Thread(target=self._run, args=(store,), name="inactivity-sweeper", daemon=True)
+            self._thread.start()
+
+    def schedule(self, user_id, deadline, timer_id, fase, contexto):
+        pass
+
+    def cancel(self, user_id):
+        pass
+
+    def __len__(self):
+        return len(self._em_curso)
+
+    def _eleger(self):
+        fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # O descritor fica aberto (e o flock detido) até o processo terminar.
+        return True
+
+    def _run(self, store):
+        while not self._eleger():
+            time.sleep(INACTIVITY_ELECTION_INTERVAL)
+        self.lider = True
+        logging.info(f"[Timer] Processo {os.getpid()} eleito responsável pelos temporizadores de inatividade.")
+        while True:
+            try:
+                for user_id, state in store.due_timers(time.time()):
+                    chave = (user_id, state['timer_id'], state.get('timer_fase', 'aviso'))
+                    with self._lock:
+                        if chave in self._em_curso:
+                            continue
+                        self._em_curso.add(chave)
+                    self._executor.submit(self._disparar, chave, state.get('envio'))
+            except Exception as e:
+                logging.error(f"[Timer] Erro ao consultar temporizadores vencidos: {e}")
+            time.sleep(INACTIVITY_POLL_INTERVAL)
+
+    def _disparar(self, chave, contexto):
+        user_id, timer_id, fase = chave
+        try:
+            self._callback(user_id, timer_id, fase, contexto)
+        except Exception as e:
+            logging.error(f"[Timer] Erro no temporizador de {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._em_curso.discard(chave)
+
+def armar_inatividade(user_id, state, contexto, fase='aviso', atraso=None, timer_id=None):
+    """Regista no estado e no agendador o próximo prazo de inatividade do utilizador."""
+    timer_id = timer_id or time.time()
+    deadline = time.time() + (INACTIVITY_PROMPT_DELAY if atraso is None else atraso)
+    state['timer_id'] = timer_id
+    state['timer_deadline'] = deadline
+    state['timer_fase'] = fase
+    state['envio'] = {'instance': contexto.get('instance'), 'apikey': contexto.get('apikey')}
+    inactivity_scheduler.schedule(user_id, deadline, timer_id, fase, contexto)
+    return timer_id
+
+def desarmar_inatividade(user_id, state):
+    """Cancela o temporizador de inatividade do utilizador. Devolve True se havia um."""
+    inactivity_scheduler.cancel(user_id)
+    if not state.get('timer_id'):
+        return False
+    state['timer_id'] = None
+    for campo in ('timer_deadline', 'timer_fase', 'envio'):
+        state.pop(campo, None)
+    return True
+
+def handle_inactivity(user_id, timer_id, fase, contexto):
+    if contexto is None or not contexto.get('data'):
+        # Prazo recuperado do estado guardado: só temos a instância e a apikey.
+        contexto = dict(contexto or {}, data={'key': {'remoteJid': user_id}})
+
+    user_lock = user_locks.get(user_id)
+    if fase == 'aviso':
+        with user_lock:
+            state = get_user_state(user_id)
+            if not state or state.get('timer_id') != timer_id or state.get('timer_fase', 'aviso') != 'aviso':
+                logging.info(f"[Timer] Timer {timer_id} para {user_id} cancelado.")
+                return
+
+            state['stage'] = 'awaiting_inactivity_response'
+            armar_inatividade(user_id, state, contexto, fase='encerramento', atraso=INACTIVITY_CLOSE_DELAY, timer_id=timer_id)
+            save_user_state(user_id, state)
+            state_store.flush(user_id)
+
+        inactivity_prompt = "Olá! Notei que não interagimos há um tempo. Você ainda precisa de ajuda?\n\n1. Sim\n2. Não"
+        outbound_dispatcher.enviar(contexto, inactivity_prompt)
+        logging.info(f"[Timer] Iniciando temporizador final de {INACTIVITY_CLOSE_DELAY}s para {user_id}")
+        return
+
+    with user_lock:
         state = get_user_state(user_id)
         if not state or state.get('stage') != 'awaiting_inactivity_response' or state.get('timer_id') != timer_id:
             logging.info(f"[Timer] Timer final para {user_id} cancelado.")
+            if state.get('timer_id') == timer_id and desarmar_inatividade(user_id, state):
+                # Prazo já sem efeito: retirado do estado para não voltar a vencer.
+                save_user_state(user_id, state)
+                state_store.flush(user_id)
             return
 
         logging.info(f"Encerrando sessão de {user_id} por inatividade.")
-        final_message = "Sessão encerrada por inatividade. Se precisar, inicie uma nova conversa. Obrigado!"
-        enviar_resposta_api(dados_originais, final_message)
         delete_user_state(user_id)
+        state_store.flush(user_id)
+        slot_holds.libertar(user_id)
+
+    final_message = "Sessão encerrada por inatividade. Se precisar, inicie uma nova conversa. Obrigado!"
+    outbound_dispatcher.enviar(contexto, final_message)
+
+if MULTIPROCESSO:
+    inactivity_scheduler = SharedInactivitySweeper(handle_inactivity, os.path.join(LOCK_DIR, 'sweeper.lock'))
+else:
+    inactivity_scheduler = InactivityScheduler(handle_inactivity)
+
+# --- LIMPEZA DE ESTADOS ---
+def compactar_estado(state, expirado=False):
+    """Cópia de `state` só com o que a conversa ainda pode usar.
+
+    Das consultas guardadas ficam o ID, o assunto, a descrição e as datas; os horários oferecidos
+    só enquanto se espera pela escolha. De um estado pausado que expirou fica apenas
+    a pausa: ao ser retomada, a conversa recomeça do início.
+    """
+    if expirado and state.get('paused'):
+        return {'stage': 'start', 'paused': True}
+    compacto = dict(state)
+    for campo in ('event_to_manage', 'reschedule_event'):
+        evento = compacto.get(campo)
+        if evento and set(evento) - {'id', 'summary', 'description', 'start', 'end'}:
+            compacto[campo] = UserEventIndex._resumo(evento)
+    if 'awaiting_slot_choice' not in (compacto.get('stage'), compacto.get('last_stage')):
+        compacto.pop('available_slots', None)
+    return compacto
+
+class StateSweeper:
+    """Expira os estados sem escritas há mais de `ttl` segundos e compacta os restantes.
+
+    Os estados só são apagados no fim da conversa ou por handle_inactivity; quando um
+    reinício perde o temporizador, ficam para sempre. Cada passagem percorre o
+    StateStore sem carregar os estados e examina-os em lotes de `lote`, com uma pausa
+    entre lotes; só os parados há mais de STATE_COMPACTAR_APOS são lidos, sob o lock
+    do utilizador. Os estados pausados pelo operador não expiram, apenas são reduzidos
+    à pausa. No modo multi-processo só o processo eleito para os temporizadores limpa.
+    """
+
+    def __init__(self, ttl=STATE_TTL, intervalo=STATE_SWEEP_INTERVAL, lote=STATE_SWEEP_LOTE, pausa=STATE_SWEEP_PAUSA):
+        self.ttl = ttl
+        self.intervalo = intervalo
+        self.lote = lote
+        self.pausa = pausa
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.intervalo <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="state-sweeper", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.intervalo)
+            if not getattr(inactivity_scheduler, 'lider', True):
+                continue
+            try:
+                self.varrer()
+            except Exception as e:
+                logging.error(f"Erro na limpeza de estados: {e}")
+
+    def varrer(self, agora=None):
+        """Uma passagem completa. Devolve {'examinados', 'expirados', 'compactados', 'bytes'}."""
+        agora = agora or time.time()
+        relatorio = {'examinados': 0, 'expirados': 0, 'compactados': 0, 'bytes': 0}
+        inicio = time.perf_counter()
+        parados = []
+        for user_id, updated_at, _ in state_store.scan():
+            relatorio['examinados'] += 1
+            if agora - updated_at >= min(self.ttl, STATE_COMPACTAR_APOS):
+                parados.append(user_id)
+            if relatorio['examinados'] % self.lote == 0:
+                self._limpar(parados, agora, relatorio)
+                parados = []
+                time.sleep(self.pausa)
+        self._limpar(parados, agora, relatorio)
+        if relatorio['expirados'] or relatorio['compactados']:
+            logging.info(f"Limpeza de estados: {relatorio['examinados']} examinados, {relatorio['expirados']} expirados, "
+                         f"{relatorio['compactados']} compactados, {relatorio['bytes']} bytes libertados "
+                         f"em {time.perf_counter() - inicio:.1f}s.")
+        return relatorio
+
+    def _limpar(self, user_ids, agora, relatorio):
+        for user_id in user_ids:
+            with user_locks.get(user_id):
+                # Reavaliado sob o lock: a conversa pode ter sido retomada entretanto.
+                info = state_store.stat(user_id)
+                if info is None or agora - info[0] < min(self.ttl, STATE_COMPACTAR_APOS):
+                    continue
+                tamanho = info[1]
+                state = state_store.get(user_id)
+                if state is None:
+                    continue
+                expirado = agora - info[0] >= self.ttl
+                if expirado and not state.get('paused'):
+                    inactivity_scheduler.cancel(user_id)
+                    delete_user_state(user_id)
+                    state_store.flush(user_id)
+                    slot_holds.libertar(user_id)
+                    relatorio['expirados'] += 1
+                    relatorio['bytes'] += tamanho
+                    METRICA_LIMPEZA.inc('expirado')
+                    METRICA_LIMPEZA_BYTES.inc(n=tamanho)
+                    continue
+                compacto = compactar_estado(state, expirado)
+                if compacto == state:
+                    continue
+                # Conta como escrita: o prazo do TTL recomeça, no máximo uma vez por estado.
+                save_user_state(user_id, compacto)
+                novo = state_store.stat(user_id)
+                libertados = max(0, tamanho - novo[1]) if novo else 0
+                relatorio['compactados'] += 1
+                relatorio['bytes'] += libertados
+                METRICA_LIMPEZA.inc('compactado')
+                METRICA_LIMPEZA_BYTES.inc(n=libertados)
+
+state_sweeper = StateSweeper()
+
+def iniciar_servicos():
+    """Arranca neste processo os temporizadores de inatividade (recuperando os prazos guardados) e a limpeza.
+
+    Chamado no arranque (`python chatbot_camilla.py` ou o hook post_worker_init do
+    gunicorn.conf.py) e, por segurança, a cada mensagem; as chamadas repetidas não fazem nada.
+    """
+    inactivity_scheduler.start(state_store)
+    state_sweeper.start()
 
 # --- LÓGICA PRINCIPAL DO CHATBOT ---
-def processa_conversa(user_id, mensagem_usuario, service):
+def oferecer_horarios(user_id, state, calendar):
+    """Reserva e apresenta os próximos horários livres. Devolve a resposta, ou None se não houver horários."""
+    available_slots = availability_cache.get(lambda: get_available_slots(calendar.get_service()))
+    oferecidos = slot_holds.oferecer(user_id, [slot.isoformat() for slot in available_slots])
+    if not oferecidos:
+        return None
+    state['available_slots'] = oferecidos
+    options = [f"{i + 1}. {datetime.datetime.fromisoformat(slot).astimezone(datetime.timezone(datetime.timedelta(hours=-3))).strftime('%d/%m/%Y às %H:%M')}" for i, slot in enumerate(oferecidos)]
+    state['stage'] = 'awaiting_slot_choice'
+    return "Perfeito. Encontrei os seguintes horários disponíveis. Por favor, digite o número correspondente:\n\n" + "\n".join(options)
+
+# Etapas em que o utilizador já escolheu um horário: a reserva é renovada a cada turno.
+ETAPAS_COM_HORARIO = ('awaiting_subject', 'awaiting_confirmation')
+
+def horario_livre(slot, calendar):
+    """True se `slot` continua livre na agenda (pela cache de horários, invalidada a cada marcação)."""
+    livres = availability_cache.get(lambda: get_available_slots(calendar.get_service()))
+    return slot in {livre.isoformat() for livre in livres}
+
+def reservar_horario(user_id, slot, calendar):
+    """Reserva `slot` para `user_id`. Se a reserva tinha expirado, verifica também que continua livre na agenda.
+
+    Com a reserva caducada (p. ex. perdida num reinício), o horário pode ter sido
+    marcado por outra pessoa cuja reserva também já expirou.
+    """
+    reserva = slot_holds.reservar(user_id, slot)
+    if reserva == RESERVA_RETOMADA:
+        return horario_livre(slot, calendar)
+    return bool(reserva)
+
+def confirmar_horario(user_id, state, calendar):
+    """Renova a reserva do horário escolhido e verifica que continua disponível antes de o marcar.
+
+    A agenda só é consultada se a reserva tiver caducado agora ou num turno anterior
+    (`horario_por_verificar`, marcado pela renovação no fim de cada turno).
+    """
+    slot = state['selected_slot_start']
+    if state.get('horario_por_verificar'):
+        return bool(slot_holds.reservar(user_id, slot)) and horario_livre(slot, calendar)
+    return reservar_horario(user_id, slot, calendar)
+
+def processa_conversa(user_id, mensagem_usuario, calendar, escolha=None):
+    inicio = time.perf_counter()
     state = get_user_state(user_id)
     stage = state.get('stage')
     resposta_bot = ""
     clear_state_after = False
+    reserva_confirmada = False
     
-    clean_message = mensagem_usuario.lower().strip()
+    # Num turno agrupado, `escolha` é o último fragmento: é nele que se leem as opções
+    # (1/2, sim/não); os campos de texto livre guardam o turno completo.
+    clean_message = (mensagem_usuario if escolha is None else escolha).lower().strip()
 
     if stage == 'awaiting_inactivity_response':
         if clean_message == '1' or 'sim' in clean_message:
@@ -225,7 +2225,7 @@ def processa_conversa(user_id, mensagem_usuario, service):
             resposta_bot = "Entendido. Antes de agendar, preciso de algumas informações.\n\nQual é a área do seu caso? (Ex: Família, Criminal, Trabalhista)"
             state['stage'] = 'qualify_case_area'
         elif clean_message == '2':
-            event = find_user_event(service, user_id)
+            event = find_user_event(calendar.get_service(), user_id)
             if not event:
                 resposta_bot = "Não encontrei nenhuma consulta futura agendada para você. Gostaria de agendar uma nova?\n\n1. Sim\n2. Não"
                 state['stage'] = 'no_event_found'
@@ -251,8 +2251,9 @@ def processa_conversa(user_id, mensagem_usuario, service):
 
     elif stage == 'manage_event_choice':
         if clean_message == '1':
-            delete_calendar_event(service, state.get('event_to_manage', {}).get('id'))
-            resposta_bot = "Sua consulta anterior foi cancelada. Vamos encontrar um novo horário. Qual é a área do seu caso?"
+            # A consulta antiga só é apagada quando a nova for confirmada, no mesmo lote do Google.
+            state['reschedule_event'] = state.pop('event_to_manage', None)
+            resposta_bot = "Certo, vamos encontrar um novo horário. Sua consulta atual só será cancelada quando o novo agendamento for confirmado. Qual é a área do seu caso?"
             state['stage'] = 'qualify_case_area'
         elif clean_message == '2':
             resposta_bot = "Tem certeza que deseja cancelar sua consulta?\n\n1. Sim\n2. Não"
@@ -262,7 +2263,7 @@ def processa_conversa(user_id, mensagem_usuario, service):
     
     elif stage == 'confirm_cancellation':
         if clean_message == '1' or 'sim' in clean_message:
-            if delete_calendar_event(service, state.get('event_to_manage', {}).get('id')):
+            if delete_calendar_event(calendar.get_service(), state.get('event_to_manage', {}).get('id')):
                 resposta_bot = "Sua consulta foi cancelada com sucesso. A vaga já está disponível para outros clientes. Obrigado!"
             else:
                 resposta_bot = "Ocorreu um erro ao tentar cancelar sua consulta."
@@ -293,26 +2294,31 @@ def processa_conversa(user_id, mensagem_usuario, service):
             proceed = False
         
         if proceed:
-            available_slots = get_available_slots(service)
-            if not available_slots:
+            resposta_bot = oferecer_horarios(user_id, state, calendar)
+            if not resposta_bot:
                 resposta_bot = "Obrigado pelas informações. Infelizmente, não encontrei horários disponíveis na próxima semana. Por favor, tente mais tarde."
                 clear_state_after = True
-            else:
-                state['available_slots'] = [slot.isoformat() for slot in available_slots]
-                options = [f"{i + 1}. {datetime.datetime.fromisoformat(slot).astimezone(datetime.timezone(datetime.timedelta(hours=-3))).strftime('%d/%m/%Y às %H:%M')}" for i, slot in enumerate(available_slots)]
-                resposta_bot = "Perfeito. Encontrei os seguintes horários disponíveis. Por favor, digite o número correspondente:\n\n" + "\n".join(options)
-                state['stage'] = 'awaiting_slot_choice'
 
     elif stage == 'awaiting_slot_choice':
         try:
             choice_index = int(clean_message) - 1
             if 0 <= choice_index < len(state.get('available_slots', [])):
                 selected_slot_iso = state['available_slots'][choice_index]
-                selected_slot = datetime.datetime.fromisoformat(selected_slot_iso)
-                state['selected_slot_start'] = selected_slot.isoformat()
-                state['selected_slot_end'] = (selected_slot + datetime.timedelta(hours=1)).isoformat()
-                resposta_bot = "Horário selecionado. Para finalizar, por favor, informe de forma breve o assunto a ser tratado."
-                state['stage'] = 'awaiting_subject'
+                if reservar_horario(user_id, selected_slot_iso, calendar):
+                    state.pop('horario_por_verificar', None)
+                    selected_slot = datetime.datetime.fromisoformat(selected_slot_iso)
+                    state['selected_slot_start'] = selected_slot.isoformat()
+                    state['selected_slot_end'] = (selected_slot + SLOT_DURATION).isoformat()
+                    resposta_bot = "Horário selecionado. Para finalizar, por favor, informe de forma breve o assunto a ser tratado."
+                    state['stage'] = 'awaiting_subject'
+                else:
+                    # A reserva expirou e o horário foi entretanto oferecido a outra pessoa.
+                    resposta_bot = oferecer_horarios(user_id, state, calendar)
+                    if resposta_bot:
+                        resposta_bot = "Esse horário acabou de ser reservado por outra pessoa. " + resposta_bot
+                    else:
+                        resposta_bot = "Esse horário acabou de ser reservado por outra pessoa e não encontrei outros horários disponíveis. Por favor, tente mais tarde."
+                        clear_state_after = True
             else:
                 resposta_bot = "Opção inválida."
         except (ValueError, IndexError):
@@ -331,117 +2337,589 @@ def processa_conversa(user_id, mensagem_usuario, service):
         state['stage'] = 'awaiting_confirmation'
 
     elif stage == 'awaiting_confirmation':
-        if clean_message == '1' or 'sim' in clean_message:
+        if (clean_message == '1' or 'sim' in clean_message) and not confirmar_horario(user_id, state, calendar):
+            resposta_bot = oferecer_horarios(user_id, state, calendar)
+            if resposta_bot:
+                resposta_bot = "Desculpe, esse horário deixou de estar disponível. " + resposta_bot
+            else:
+                resposta_bot = "Desculpe, esse horário deixou de estar disponível e não encontrei outros horários. Por favor, tente mais tarde."
+                clear_state_after = True
+        elif clean_message == '1' or 'sim' in clean_message:
             description = (f"Agendamento via Chatbot.\nCliente: {user_id}\nÁrea: {state.get('case_area')}\nLocal: {state.get('location')}\nJá possui advogado: {state.get('has_lawyer')}")
-            success = create_calendar_event(service, f"Consulta: {state['subject']}", datetime.datetime.fromisoformat(state['selected_slot_start']), datetime.datetime.fromisoformat(state['selected_slot_end']), description)
+            evento_args = (calendar.get_service(), f"Consulta: {state['subject']}", datetime.datetime.fromisoformat(state['selected_slot_start']), datetime.datetime.fromisoformat(state['selected_slot_end']), description)
+            anterior_cancelada = False
+            if state.get('reschedule_event'):
+                success, anterior_cancelada = reschedule_calendar_event(evento_args[0], state['reschedule_event'], *evento_args[1:], user_id=user_id)
+            else:
+                success = create_calendar_event(*evento_args, user_id=user_id)
             if success:
-                resposta_bot = ("Agendamento confirmado com sucesso! Para agilizar, envie cópia do RG e documentos para camillatannure.adv@gmail.com.")
+                if not state.get('reschedule_event'):
+                    aviso_anterior = ""
+                elif anterior_cancelada:
+                    aviso_anterior = "Sua consulta anterior foi cancelada. "
+                else:
+                    # O novo evento foi criado mas o antigo não pôde ser apagado: o utilizador tem duas consultas.
+                    anterior = datetime.datetime.fromisoformat(state['reschedule_event']['start']['dateTime']).astimezone(datetime.timezone(datetime.timedelta(hours=-3)))
+                    aviso_anterior = (f"Atenção: não foi possível cancelar sua consulta anterior de {anterior.strftime('%d/%m/%Y às %H:%M')}, "
+                                      "que continua agendada. Para cancelá-la, escolha \"Remarcar ou Cancelar\" no menu. ")
+                resposta_bot = ("Agendamento confirmado com sucesso! " + aviso_anterior
+                                + "Para agilizar, envie cópia do RG e documentos para camillatannure.adv@gmail.com.")
+                # A reserva fica até a cache de horários já refletir o novo evento.
+                slot_holds.reservar(user_id, state['selected_slot_start'], ttl=slot_holds.ttl_confirmada)
+                reserva_confirmada = True
             else:
                 resposta_bot = "Desculpe, ocorreu um erro ao agendar. A nossa equipa foi notificada."
             clear_state_after = True
         elif clean_message == '2' or 'não' in clean_message or 'nao' in clean_message:
-            resposta_bot = "Ok, agendamento cancelado. Se precisar de algo mais, é só chamar!"
+            if state.get('reschedule_event'):
+                resposta_bot = "Ok, remarcação cancelada. Sua consulta anterior continua agendada. Se precisar de algo mais, é só chamar!"
+            else:
+                resposta_bot = "Ok, agendamento cancelado. Se precisar de algo mais, é só chamar!"
             clear_state_after = True
         else:
             resposta_bot = "Por favor, responda com 1 para Sim ou 2 para Não."
 
     if clear_state_after:
         delete_user_state(user_id)
+        if not reserva_confirmada:
+            slot_holds.libertar(user_id)
     else:
         state['last_stage'] = stage
         state['last_bot_message'] = resposta_bot
+        if state.get('stage') in ETAPAS_COM_HORARIO and state.get('selected_slot_start'):
+            # Respostas a avisos de inatividade podem esticar a conversa para lá do TTL da reserva.
+            # Se a reserva já tinha caducado (ou é agora de outro), a confirmação consulta a agenda.
+            if slot_holds.reservar(user_id, state['selected_slot_start']) != RESERVA_RENOVADA:
+                state['horario_por_verificar'] = True
         save_user_state(user_id, state)
         
+    METRICA_ETAPA.observar(time.perf_counter() - inicio, stage)
     return resposta_bot
 
 # --- FUNÇÃO DE ENVIO DE RESPOSTA ---
-def enviar_resposta_api(dados_originais, texto_resposta):
+EVOLUTION_SERVER_URL = os.environ.get('EVOLUTION_SERVER_URL', 'http://127.0.0.1:8081')
+ENVIO_TIMEOUT = (3.05, 15)  # (ligação, leitura) em segundos
+ENVIO_WORKERS = int(os.environ.get('CHATBOT_ENVIO_WORKERS', '4'))
+ENVIO_QUEUE_SIZE = int(os.environ.get('CHATBOT_ENVIO_FILA', '1000'))
+ENVIO_TENTATIVAS = 4
+ENVIO_RETRY_BASE = 0.5
+ENVIO_RATE = float(os.environ.get('CHATBOT_ENVIO_RATE', '20'))  # mensagens por segundo, por instância
+ENVIO_BURST = 10
+ENVIO_ESPERA_MAX = 60  # modo multi-processo: quanto o webhook espera pela entrega da sua resposta
+ENVIO_ESPERA_FILA = 5  # segundos à espera de lugar na fila de envio antes de recusar a mensagem
+
+class ErroEnvioTransitorio(Exception):
+    """Falha de envio que vale a pena repetir (ligação, timeout, 429 ou 5xx)."""
+
+@functools.lru_cache(maxsize=256)
+def _destino_envio(instance_name, api_key):
+    url_envio = f"{EVOLUTION_SERVER_URL}/message/sendText/{instance_name}"
+    headers = {"apikey": api_key, "Content-Type": "application/json"}
+    return url_envio, headers
+
+def enviar_resposta_api(dados_originais, texto_resposta, session=None):
     if not texto_resposta: return
+    instance_name = dados_originais.get('instance')
+    remetente_jid = dados_originais.get('data', {}).get('key', {}).get('remoteJid')
+    api_key = dados_originais.get('apikey')
+    if not all([instance_name, remetente_jid, api_key]): return
+    url_envio, headers = _destino_envio(instance_name, api_key)
+    numero_limpo = remetente_jid.split('@')[0]
+    payload_resposta = {"number": numero_limpo, "text": texto_resposta}
+    logging.debug("A enviar resposta para %s com o payload: %s", numero_limpo, payload_resposta)
+    try:
+        response = (session or requests).post(url_envio, json=payload_resposta, headers=headers, timeout=ENVIO_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise ErroEnvioTransitorio(str(e))
+    if response.status_code == 429 or response.status_code >= 500:
+        raise ErroEnvioTransitorio(f"HTTP {response.status_code}")
     try:
-        instance_name = dados_originais.get('instance')
-        remetente_jid = dados_originais.get('data', {}).get('key', {}).get('remoteJid')
-        api_key = dados_originais.get('apikey')
-        evolution_server_url = "http://127.0.0.1:8081"
-        if not all([instance_name, remetente_jid, api_key]): return
-        url_envio = f"{evolution_server_url}/message/sendText/{instance_name}"
-        headers = {"apikey": api_key, "Content-Type": "application/json"}
-        numero_limpo = remetente_jid.split('@')[0]
-        payload_resposta = {"number": numero_limpo, "text": texto_resposta}
-        logging.info(f"A enviar resposta para {numero_limpo} com o payload: {payload_resposta}")
-        response = requests.post(url_envio, json=payload_resposta, headers=headers)
         response.raise_for_status()
-        logging.info(f"Resposta enviada com sucesso. Status: {response.status_code}")
-        return True
-    except Exception as e:
+    except requests.HTTPError as e:
         logging.error(f"Erro ao enviar resposta via API: {e}")
         return False
+    logging.info(f"Resposta enviada com sucesso. Status: {response.status_code}")
+    return True
+
+class _TokenBucket:
+    """Limite de débito por reserva: devolve quanto tempo esperar antes de enviar."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self):
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (agora - self._ultimo) * self.rate)
+            self._ultimo = agora
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+class OutboundDispatcher:
+    """Entrega as respostas à Evolution API fora do pedido do webhook.
+
+    As mensagens vão para uma PartitionedQueue por remoteJid, por isso as respostas
+    a um utilizador saem pela ordem em que foram enfileiradas. Cada worker tem a sua
+    requests.Session (ligações keep-alive), repete falhas transitórias com backoff
+    exponencial com jitter e respeita um limite de débito por instância.
+    O resultado da entrega é passado a `ao_concluir`, numa thread à parte.
+    """
+
+    def __init__(self, workers=ENVIO_WORKERS, queue_size=ENVIO_QUEUE_SIZE):
+        self._filas = PartitionedQueue("envio", self._processar, workers, queue_size, init_worker=requests.Session)
+        self._callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix="envio-callback")
+        self._callbacks_pendentes = set()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reservar(self, remote_jid, timeout=0):
+        """Guarda lugar para a próxima resposta a `remote_jid` (ver PartitionedQueue.reservar)."""
+        return self._filas.reservar(remote_jid, timeout)
+
+    def libertar(self, remote_jid):
+        self._filas.libertar(remote_jid)
+
+    def enviar(self, contexto, texto, ao_concluir=None, reservado=False):
+        """Enfileira uma mensagem. Devolve False se não houver nada a enviar ou a fila estiver cheia.
+
+        Com `reservado`, usa o lugar guardado por `reservar` (devolvido se não houver nada a enviar).
+        """
+        remote_jid = contexto.get('data', {}).get('key', {}).get('remoteJid')
+        if not texto or not remote_jid:
+            if reservado and remote_jid:
+                self._filas.libertar(remote_jid)
+            return False
+        if not self._filas.submeter(remote_jid, (contexto, texto, ao_concluir), reservado=reservado):
+            logging.error(f"Fila de envio cheia; resposta para {remote_jid} descartada.")
+            return False
+        return True
+
+    def pendentes(self):
+        return self._filas.pendentes()
+
+    def esvaziar(self):
+        """Bloqueia até todas as mensagens enfileiradas terem sido entregues e os callbacks corridos."""
+        self._filas.esvaziar()
+        with self._lock:
+            pendentes = list(self._callbacks_pendentes)
+        futures.wait(pendentes)
+
+    def fechar(self, timeout=10):
+        """Entrega o que está nas filas e termina os workers."""
+        self._filas.fechar(timeout)
+        self._callbacks.shutdown(wait=True)
+
+    def _bucket(self, instance_name):
+        with self._lock:
+            bucket = self._buckets.get(instance_name)
+            if bucket is None:
+                bucket = self._buckets[instance_name] = _TokenBucket(ENVIO_RATE, ENVIO_BURST)
+            return bucket
+
+    def _processar(self, session, item):
+        contexto, texto, ao_concluir = item
+        enviado = self._entregar(session, contexto, texto)
+        if ao_concluir is None:
+            return
+        try:
+            futuro = self._callbacks.submit(ao_concluir, enviado)
+        except RuntimeError:
+            # Executor já encerrado (fim do processo): corre o callback aqui mesmo.
+            ao_concluir(enviado)
+            return
+        with self._lock:
+            self._callbacks_pendentes.add(futuro)
+        futuro.add_done_callback(self._callback_concluido)
+
+    def _callback_concluido(self, futuro):
+        with self._lock:
+            self._callbacks_pendentes.discard(futuro)
+        if futuro.exception() is not None:
+            logging.error(f"Erro no callback de envio: {futuro.exception()}")
+
+    def _entregar(self, session, contexto, texto):
+        bucket = self._bucket(contexto.get('instance'))
+        for tentativa in range(ENVIO_TENTATIVAS):
+            time.sleep(bucket.reservar())
+            inicio = time.perf_counter()
+            try:
+                enviado = bool(enviar_resposta_api(contexto, texto, session))
+                if not enviado:
+                    METRICA_ENVIO_ERROS.inc('recusado')
+                return enviado
+            except ErroEnvioTransitorio as e:
+                METRICA_ENVIO_ERROS.inc('transitorio')
+                if tentativa == ENVIO_TENTATIVAS - 1:
+                    logging.error(f"Erro ao enviar resposta via API após {ENVIO_TENTATIVAS} tentativas: {e}")
+                    return False
+                espera = random.uniform(0, ENVIO_RETRY_BASE * (2 ** tentativa))
+                logging.warning(f"Falha transitória ao enviar resposta ({e}); nova tentativa em {espera:.2f}s.")
+                time.sleep(espera)
+            except Exception as e:
+                METRICA_ENVIO_ERROS.inc('erro')
+                logging.error(f"Erro ao enviar resposta via API: {e}")
+                return False
+            finally:
+                METRICA_ENVIO.observar(time.perf_counter() - inicio)
+
+outbound_dispatcher = OutboundDispatcher()
+atexit.register(outbound_dispatcher.fechar)
+
+def _apos_resposta(remote_jid, contexto, enviado):
+    """Depois da entrega: arma o temporizador de inatividade e grava o estado do utilizador."""
+    with user_locks.get(remote_jid):
+        if enviado:
+            state = state_store.get(remote_jid)
+            if state: # Se o estado ainda existir (conversa não terminou)
+                timer_id = armar_inatividade(remote_jid, state, contexto)
+                save_user_state(remote_jid, state)
+                logging.info(f"[Timer] Temporizador de {INACTIVITY_PROMPT_DELAY}s armado para {remote_jid} (ID: {timer_id})")
+        # Única escrita durável desta mensagem.
+        state_store.flush(remote_jid)
 
 # --- ROTA DO WEBHOOK ---
+# Modo "fast-ack": o /chat valida e enfileira a mensagem e responde de imediato;
+# o processamento corre em workers, com as mensagens de cada remoteJid em ordem.
+PIPELINE_ATIVO = os.environ.get('CHATBOT_FAST_ACK', '0') == '1'
+PIPELINE_WORKERS = int(os.environ.get('CHATBOT_PIPELINE_WORKERS', '8'))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('CHATBOT_PIPELINE_FILA', '2000'))
+PIPELINE_DRAIN_TIMEOUT = 30
+# Agrupamento de rajadas: mensagens do mesmo remoteJid que chegam dentro da janela
+# são respondidas como um único turno. 0 desativa.
+COALESCE_JANELA = float(os.environ.get('CHATBOT_COALESCE_MS', '0')) / 1000
+COALESCE_JANELA_MAX = float(os.environ.get('CHATBOT_COALESCE_MAX_MS', '5000')) / 1000  # desde a primeira mensagem
+COALESCE_MAX_MENSAGENS = 10
+
+def extrair_mensagem(dados):
+    """Valida um payload messages.upsert. Devolve (remote_jid, mensagem, is_from_me) ou None."""
+    data = dados.get('data')
+    if not isinstance(data, dict) or not isinstance(data.get('key'), dict) or not isinstance(data.get('message'), dict):
+        return None
+    is_from_me = data['key'].get('fromMe', False)
+    remote_jid = data['key'].get('remoteJid')
+    extendido = data['message'].get('extendedTextMessage')
+    mensagem_usuario = data['message'].get('conversation') or (extendido.get('text') if isinstance(extendido, dict) else None)
+    if not isinstance(remote_jid, str) or not remote_jid or not isinstance(mensagem_usuario, str) or not mensagem_usuario:
+        return None
+    return remote_jid, mensagem_usuario, is_from_me
+
+FILA_ENVIO_CHEIA = "fila de envio cheia"
+
+def processa_mensagem(dados, espera_envio=ENVIO_ESPERA_FILA):
+    """Trata uma mensagem messages.upsert válida. Devolve o estado a reportar ao webhook.
+
+    Antes de avançar a conversa guarda lugar para a resposta na fila de envio,
+    esperando até `espera_envio` segundos; se não houver, o estado fica como estava
+    e devolve o estado FILA_ENVIO_CHEIA (o webhook responde 503).
+    """
+    inicio = time.perf_counter()
+    remote_jid, mensagem_usuario, is_from_me = extrair_mensagem(dados)
+    try:
+        # Lock por utilizador: as mensagens de cada remoteJid são processadas em ordem,
+        # sem bloquear as conversas dos restantes utilizadores.
+        iniciar_servicos()
+        user_lock = user_locks.get(remote_jid)
+        with user_lock:
+            state = get_user_state(remote_jid)
+            if desarmar_inatividade(remote_jid, state):
+                save_user_state(remote_jid, state)
+
+            if is_from_me:
+                if '@pare' in mensagem_usuario.lower():
+                    state['paused'] = True
+                    save_user_state(remote_jid, state)
+                    logging.info(f"Chatbot pausado para o cliente {remote_jid}.")
+                elif '@ok' in mensagem_usuario.lower():
+                    state['paused'] = False
+                    save_user_state(remote_jid, state)
+                    logging.info(f"Chatbot retomado para o cliente {remote_jid}.")
+                state_store.flush(remote_jid)
+                return {"status": "comando processado"}
+
+            if state.get('paused', False):
+                logging.info(f"Bot pausado, ignorando mensagem de {remote_jid}.")
+                state_store.flush(remote_jid)
+                return {"status": "bot pausado, mensagem ignorada"}
+
+            fragmentos = dados.get('_fragmentos')
+            if fragmentos:
+                logging.info(f"{len(fragmentos)} mensagens de {remote_jid} agrupadas num turno: {fragmentos}")
+            else:
+                logging.info(f"Mensagem '{mensagem_usuario}' recebida de {remote_jid}")
+            if not outbound_dispatcher.reservar(remote_jid, espera_envio):
+                logging.warning(f"Fila de envio cheia; mensagem de {remote_jid} recusada sem alterar a conversa.")
+                state_store.flush(remote_jid)
+                return {"status": FILA_ENVIO_CHEIA}
+            try:
+                resposta_bot = processa_conversa(remote_jid, mensagem_usuario, calendar_client, escolha=fragmentos[-1] if fragmentos else None)
+            except BaseException:
+                outbound_dispatcher.libertar(remote_jid)
+                raise
+
+            # Só se enfileira a resposta; o temporizador é armado depois da entrega.
+            contexto = contexto_envio(dados)
+            entregue = threading.Event()
+
+            def concluir(enviado):
+                try:
+                    _apos_resposta(remote_jid, contexto, enviado)
+                finally:
+                    entregue.set()
+
+            enfileirada = outbound_dispatcher.enviar(contexto, resposta_bot, concluir, reservado=True)
+            if not enfileirada:
+                state_store.flush(remote_jid)
+
+        if MULTIPROCESSO and enfileirada:
+            # A próxima mensagem deste utilizador pode ir para outro processo, com outro
+            # dispatcher; esperar pela entrega (já fora do lock) mantém as respostas em ordem.
+            entregue.wait(ENVIO_ESPERA_MAX)
+        return {"status": "mensagem processada"}
+
+    except CalendarIndisponivel as e:
+        logging.error(f"Google Agenda indisponível ao processar a mensagem: {e}")
+        return {"status": "erro de autenticação com o google"}
+    except Exception as e:
+        logging.error(f"Ocorreu um erro ao processar a mensagem: {e}")
+        return {"status": "erro interno"}
+    finally:
+        logging.debug(f"Mensagem de {remote_jid} processada em {(time.perf_counter() - inicio) * 1000:.1f} ms")
+
+# Nos workers não há webhook à espera: aguarda-se mais tempo por lugar na fila de envio,
+# o que trava a fila de processamento, que por sua vez passa a responder 503.
+message_pipeline = PartitionedQueue("conversa", lambda _, dados: processa_mensagem(dados, ENVIO_ESPERA_MAX),
+                                    PIPELINE_WORKERS, PIPELINE_QUEUE_SIZE)
+# Registado depois do dispatcher, por isso corre antes dele no fim do processo:
+# as mensagens pendentes são processadas e as respostas ainda são entregues.
+atexit.register(lambda: message_pipeline.fechar(PIPELINE_DRAIN_TIMEOUT))
+
+class _Rajada:
+    def __init__(self, dados, fecho, limite):
+        self.mensagens = [dados]
+        self.fecho = fecho
+        self.limite = limite
+        self.pronta = threading.Event()
+        self.dados = None
+
+class MessageCoalescer:
+    """Junta as mensagens de um remoteJid que chegam dentro de `janela` segundos.
+
+    Cada mensagem nova adia o fecho da rajada em `janela`, até `janela_max` desde a
+    primeira ou até `max_mensagens`. Os fechos vivem num heap servido por uma única
+    thread, que entrega a `ao_fechar` a rajada com um payload de textos juntos (um
+    por linha) e a lista dos fragmentos em `_fragmentos`.
+    """
+
+    def __init__(self, ao_fechar, janela=COALESCE_JANELA, janela_max=COALESCE_JANELA_MAX, max_mensagens=COALESCE_MAX_MENSAGENS):
+        self._ao_fechar = ao_fechar
+        self.janela = janela
+        self.janela_max = janela_max
+        self.max_mensagens = max_mensagens
+        self._abertas = {}  # remote_jid -> _Rajada
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def juntar(self, remote_jid, dados, pode_abrir=None):
+        """Acrescenta a mensagem à rajada aberta do utilizador. Devolve (rajada, nova).
+
+        Se for preciso abrir uma rajada e `pode_abrir()` devolver False, nada é feito
+        e devolve (None, True).
+        """
+        agora = time.monotonic()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+                self._thread.start()
+            rajada = self._abertas.get(remote_jid)
+            nova = rajada is None
+            if nova and pode_abrir is not None and not pode_abrir():
+                return None, True
+            if nova:
+                rajada = self._abertas[remote_jid] = _Rajada(dados, agora + self.janela, agora + self.janela_max)
+            else:
+                rajada.mensagens.append(dados)
+                rajada.fecho = agora if len(rajada.mensagens) >= self.max_mensagens else min(agora + self.janela, rajada.limite)
+            heapq.heappush(self._heap, (rajada.fecho, remote_jid))
+            self._cond.notify()
+            return rajada, nova
+
+    def abertas(self):
+        with self._cond:
+            return len(self._abertas)
+
+    def fechar(self):
+        """Fecha já todas as rajadas abertas (fim do processo)."""
+        with self._cond:
+            rajadas = list(self._abertas.values())
+            self._abertas.clear()
+        for rajada in rajadas:
+            self._entregar(rajada)
+
+    def _proxima(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                fecho, remote_jid = self._heap[0]
+                atraso = fecho - time.monotonic()
+                if atraso > 0:
+                    self._cond.wait(atraso)
+                    continue
+                heapq.heappop(self._heap)
+                rajada = self._abertas.get(remote_jid)
+                # Entradas de fechos entretanto adiados são descartadas.
+                if rajada is not None and rajada.fecho == fecho:
+                    del self._abertas[remote_jid]
+                    return rajada
+
+    def _run(self):
+        while True:
+            self._entregar(self._proxima())
+
+    def _entregar(self, rajada):
+        try:
+            rajada.dados = juntar_mensagens(rajada.mensagens)
+            self._ao_fechar(rajada)
+        except Exception as e:
+            logging.error(f"Erro ao entregar mensagens agrupadas: {e}")
+        finally:
+            rajada.pronta.set()
+
+def juntar_mensagens(mensagens):
+    """Um payload messages.upsert com os textos de `mensagens`, pela ordem de chegada."""
+    if len(mensagens) == 1:
+        return mensagens[0]
+    fragmentos = [extrair_mensagem(dados)[1] for dados in mensagens]
+    ultimo = mensagens[-1]
+    data = dict(ultimo['data'], message={'conversation': "\n".join(fragmentos)})
+    return dict(ultimo, data=data, _fragmentos=fragmentos)
+
+def _rajada_fechada(rajada):
+    if not PIPELINE_ATIVO:
+        return  # o pedido que abriu a rajada espera por `rajada.pronta` e processa-a
+    # O lugar na fila foi reservado quando a rajada abriu: só falha se a fila já estiver fechada.
+    remote_jid = rajada.dados['data']['key']['remoteJid']
+    if not message_pipeline.submeter(remote_jid, rajada.dados, reservado=True):
+        logging.error(f"Fila de processamento fechada; {len(rajada.mensagens)} mensagens de {remote_jid} descartadas.")
+
+message_coalescer = MessageCoalescer(_rajada_fechada)
+# Registado depois da fila de processamento: as rajadas abertas entram nela antes de ser drenada.
+atexit.register(message_coalescer.fechar)
+
 @app.route("/chat", methods=["POST"])
 def chat():
-    service = get_calendar_service()
-    if not service: return jsonify({"status": "erro de autenticação com o google"})
+    with METRICA_CHAT.cronometrar():
+        return _tratar_chat()
 
-    dados = request.json
+def _tratar_chat():
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        dados = {}  # corpo vazio, JSON inválido ou que não é um objeto
     evento = dados.get("event")
-    
-    if evento == "messages.upsert":
-        try:
-            is_from_me = dados.get('data', {}).get('key', {}).get('fromMe', False)
-            remote_jid = dados.get('data', {}).get('key', {}).get('remoteJid')
-            mensagem_usuario = dados.get('data', {}).get('message', {}).get('conversation') or \
-                               dados.get('data', {}).get('message', {}).get('extendedTextMessage', {}).get('text')
-
-            if not remote_jid or not mensagem_usuario: return jsonify({"status": "payload inválido"})
-
-            # --- CORREÇÃO APLICADA AQUI: LOCK GLOBAL ---
-            # Garante que apenas uma mensagem por vez seja processada para qualquer utilizador, evitando race conditions.
-            with user_states_lock:
-                state = get_user_state(remote_jid)
-                if state.get('timer_id'):
-                    state['timer_id'] = None
-                    save_user_state(remote_jid, state)
 
-                if is_from_me:
-                    if '@pare' in mensagem_usuario.lower():
-                        state['paused'] = True
-                        save_user_state(remote_jid, state)
-                        logging.info(f"Chatbot pausado para o cliente {remote_jid}.")
-                    elif '@ok' in mensagem_usuario.lower():
-                        state['paused'] = False
-                        save_user_state(remote_jid, state)
-                        logging.info(f"Chatbot retomado para o cliente {remote_jid}.")
-                    return jsonify({"status": "comando processado"})
-                
-                else:
-                    if state.get('paused', False):
-                        logging.info(f"Bot pausado, ignorando mensagem de {remote_jid}.")
-                        return jsonify({"status": "bot pausado, mensagem ignorada"})
-
-                    logging.info(f"Mensagem '{mensagem_usuario}' recebida de {remote_jid}")
-                    resposta_bot = processa_conversa(remote_jid, mensagem_usuario, service)
-                    
-                    if enviar_resposta_api(dados, resposta_bot):
-                        state = get_user_state(remote_jid)
-                        if state: # Se o estado ainda existir (conversa não terminou)
-                            timer_id = time.time()
-                            state['timer_id'] = timer_id
-                            save_user_state(remote_jid, state)
-                            timer = threading.Thread(target=handle_inactivity, args=(remote_jid, copy.deepcopy(dados), timer_id))
-                            timer.start()
+    if evento != "messages.upsert":
+        return jsonify({"status": f"evento {evento} ignorado"})
 
-        except Exception as e:
-            logging.error(f"Ocorreu um erro ao processar a mensagem: {e}")
-            return jsonify({"status": "erro interno"})
+    mensagem = extrair_mensagem(dados)
+    if mensagem is None: return jsonify({"status": "payload inválido"})
+
+    # Reentregas da Evolution trazem o mesmo data.key.id: respondidas sem carregar estado.
+    message_id = dados.get('data', {}).get('key', {}).get('id')
+    if message_id and not message_dedup.registar(message_id):
+        logging.info(f"Mensagem {message_id} de {mensagem[0]} já recebida; ignorada.")
+        return jsonify({"status": "mensagem duplicada ignorada"})
+
+    remote_jid, _, is_from_me = mensagem
+    if COALESCE_JANELA > 0 and not is_from_me:
+        # Em modo fast-ack cada rajada nova reserva já o seu lugar na fila: se estiver
+        # cheia, o webhook responde 503 e a Evolution volta a entregar a mensagem.
+        reservar = (lambda: message_pipeline.reservar(remote_jid)) if PIPELINE_ATIVO else None
+        rajada, nova = message_coalescer.juntar(remote_jid, dados, pode_abrir=reservar)
+        if rajada is None:
+            logging.warning(f"Fila de processamento cheia; mensagem de {remote_jid} recusada.")
+            if message_id:
+                message_dedup.esquecer(message_id)
+            return jsonify({"status": "fila cheia"}), 503
+        if not nova:
+            return jsonify({"status": "mensagem agrupada"})
+        if PIPELINE_ATIVO:
+            return jsonify({"status": "mensagem enfileirada"})
+        # Este pedido abriu a rajada: espera que feche e responde pelo turno inteiro.
+        rajada.pronta.wait()
+        return _resposta_webhook(processa_mensagem(rajada.dados), message_id)
+
+    if PIPELINE_ATIVO:
+        if not message_pipeline.submeter(mensagem[0], dados):
+            logging.warning(f"Fila de processamento cheia; mensagem de {mensagem[0]} recusada.")
+            if message_id:
+                message_dedup.esquecer(message_id)
+            return jsonify({"status": "fila cheia"}), 503
+        return jsonify({"status": "mensagem enfileirada"})
 
-    return jsonify({"status": f"evento {evento} ignorado"})
+    return _resposta_webhook(processa_mensagem(dados), message_id)
+
+def _resposta_webhook(resultado, message_id):
+    # Mensagem recusada por falta de lugar para a resposta: 503 para a Evolution a reenviar.
+    if resultado.get('status') == FILA_ENVIO_CHEIA:
+        if message_id:
+            message_dedup.esquecer(message_id)
+        return jsonify(resultado), 503
+    return jsonify(resultado)
 
 # --- ROTAS E EXECUÇÃO ---
+METRICAS_CONTAGEM_TTL = 30  # segundos entre contagens dos estados guardados
+
+@functools.lru_cache(maxsize=1)
+def _contar_estados(periodo):
+    return state_store.count()
+
+metricas.medidor('chatbot_conversas_ativas', "Conversas com estado guardado (contadas no máximo a cada 30 s).",
+                 lambda: _contar_estados(int(time.time() // METRICAS_CONTAGEM_TTL)))
+metricas.medidor('chatbot_temporizadores_pendentes', "Temporizadores de inatividade pendentes neste processo.", lambda: len(inactivity_scheduler))
+metricas.medidor('chatbot_locks_ativos', "Locks de utilizador em uso.", lambda: len(user_locks))
+metricas.medidor('chatbot_reservas_horarios', "Horários reservados em memória (0 com reservas no SQLite).", lambda: len(slot_holds))
+metricas.medidor('chatbot_fila_pendentes', "Itens à espera em cada fila.", lambda: {
+    'conversa': message_pipeline.pendentes(), 'envio': outbound_dispatcher.pendentes(), 'rajadas': message_coalescer.abertas(),
+}, 'fila')
+metricas.medidor('chatbot_cache_horarios_total', "Acessos à cache de horários livres.", lambda: dict(availability_cache.stats), 'resultado', tipo='counter')
+
+@app.route("/metrics")
+def metrics():
+    return metricas.exportar(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route("/")
 def index():
     logging.info(f"Chatbot version {CHATBOT_VERSION} is running.")
     return f"<h1>API do Chatbot de Agendamento (Versão {CHATBOT_VERSION}) está no ar!</h1>"
 
 if __name__ == "__main__":
-    get_calendar_service()
-    app.run(host='0.0.0.0', port=5000)
+    parser = argparse.ArgumentParser(description=f"Chatbot de Agendamento (Versão {CHATBOT_VERSION})")
+    sub = parser.add_subparsers(dest='comando')
+    p = sub.add_parser('migrar-estados', help="importa os ficheiros JSON de estado para o SQLite")
+    p.add_argument('--origem', default=STATE_DIR)
+    p.add_argument('--destino', default=STATE_DB)
+    p = sub.add_parser('limpar-estados', help="expira os estados abandonados e compacta os restantes (uma passagem)")
+    p.add_argument('--ttl', type=int, default=STATE_TTL, help="segundos sem escritas até um estado expirar")
+    p = sub.add_parser('cancelar-dia', help="apaga, em lotes, as consultas marcadas pelo chatbot num dia")
+    p.add_argument('dia', type=datetime.date.fromisoformat, help="AAAA-MM-DD (hora de Brasília)")
+    p.add_argument('--confirmar', action='store_true', help="sem esta opção apenas lista as consultas")
+    args = parser.parse_args()
+
+    if args.comando == 'migrar-estados':
+        migrar_estados(args.origem, args.destino)
+    elif args.comando == 'limpar-estados':
+        relatorio = StateSweeper(ttl=args.ttl).varrer()
+        if not (relatorio['expirados'] or relatorio['compactados']):
+            logging.info(f"Limpeza de estados: {relatorio['examinados']} examinados, nada a limpar.")
+    elif args.comando == 'cancelar-dia':
+        cancel_events_on_day(args.dia, args.confirmar)
+    else:
+        get_calendar_service()
+        iniciar_servicos()
+        app.run(host='0.0.0.0', port=5000)
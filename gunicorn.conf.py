@@ -0,0 +1,11 @@
+# Lido automaticamente pelo gunicorn quando é arrancado nesta pasta.
+
+def post_worker_init(worker):
+    """Arranca os temporizadores de inatividade e a limpeza de estados em cada worker, já carregado o app.
+
+    Sem isto só arrancariam com a primeira mensagem: depois de um reinício sem tráfego,
+    os prazos recuperados nunca venceriam. Funciona também com --preload, em que os
+    threads arrancados no processo principal não passam para os workers.
+    """
+    import chatbot_camilla
+    chatbot_camilla.iniciar_servicos()